@@ -22,9 +22,14 @@ from functools import wraps
 from .core import logger, convert_level, log_traceback, config as core_config
 from .core import get_real_ip
 from .core import get_app, get_db, send, product, is_secure_mode, is_use_limits
+from .core import route, dispatch
 from .core import check_addr_limit, OverlimitError, reset_addr_limits
+from .core import QueueFullError, dispatcher_stats, dead_letter_replay
+from .core import Event
+from .core import endpoint_circuit_state
 
 from .core import addr_get, addr_list, addr_create, addr_delete
+from .core import addr_get_cached
 from .core import addr_set_active, addr_set_limit, addr_change
 
 from .core import endpoint_get, endpoint_list, endpoint_create
@@ -274,6 +279,8 @@ def init():
 
         method_decorators = [public_method]
 
+        # the parser is used for API docs only, requests are parsed with
+        # _parse_push_item
         p_push = reqparse.RequestParser()
         p_push.add_argument('addr',
                             required=True,
@@ -313,8 +320,10 @@ def init():
         @api.response(202, 'event message successfully accepted')
         @api.response(404, 'recipient address not found')
         @api.response(406, 'recipient address is disabled')
-        @api.response(429, 'recipient address is out of limit')
-        @api.response(503, 'server error')
+        @api.response(
+            429, 'recipient address is out of limit or dispatch queue is '
+            'full for low-priority events')
+        @api.response(503, 'dispatch queue is full or server error')
         @api.expect(p_push, validate=True)
         def post(self):
             """
@@ -323,78 +332,133 @@ def init():
             try:
                 event_id = str(uuid.uuid4())
                 try:
-                    a = self.p_push.parse_args(strict=True)
-                except Exception as e:
+                    payload, media = _push_request_payload()
+                    a = _parse_push_item(payload)
+                except ValueError as e:
                     return str(e), 400
                 logger.info(f'API message to {a.addr}')
-                # TODO: remove keywords when removing legacy
-                if a.keywords is not None:
-                    a.tag = a.keywords
-                if a.media:
-                    try:
-                        media = base64.b64decode(a.media)
-                        if a.media_fname and '/' in a.media_fname:
-                            a.media_fname = a.media_fname.rsplit('/', 1)[-1]
-                    except:
-                        media = None
-                        a.media = None
-                        logger.warning(
-                            f'API invalid media file, event {event_id}'
-                            f' message to {a.addr}')
-                else:
-                    media = None
-                level = convert_level(a.level)
-                level_name = logging.getLevelName(level)
-                if a.sender:
-                    s = a.sender.split('@', 1)[0] if a.location else a.sender
-                else:
-                    s = None
-                formatted_subject = '{} {}{}{}'.format(
-                    level_name, s if s is not None else '',
-                    f'@{a.location}' if a.location else '',
-                    f': {a.subject}' if a.subject else '')
-
+                event = _format_event(a, event_id, media=media)
                 try:
-                    addr = addr_get(addr=a.addr)
+                    addr = addr_get_cached(a.addr)
                     if addr['active'] < 1:
                         return f'addr {a.addr} is disabled', 406
                     if is_use_limits():
                         check_addr_limit(addr,
-                                         level=level,
+                                         level=event.level,
                                          size=request.content_length)
                 except LookupError:
                     logger.info(f'API no such address: {a.addr}')
                     return f'addr {a.addr} not found', 404
                 except OverlimitError as e:
                     return str(e), 429
-                for row in get_db().query('push',
-                                          a=a.addr,
-                                          location=a.location,
-                                          tag=a.tag,
-                                          sender=a.sender,
-                                          level=level):
-                    send(row.plugin_name,
-                         config=json.loads(row.config)
-                         if is_parse_db_json() else row.config,
-                         event_id=event_id,
-                         addr=a.addr,
-                         addr_id=row.addr_id,
-                         msg=a.msg,
-                         subject=a.subject,
-                         formatted_subject=formatted_subject,
-                         level=level,
-                         level_name=level_name,
-                         location=a.location,
-                         tag=a.tag,
-                         sender=a.sender,
-                         media=media,
-                         media_encoded=a.media,
-                         media_fname=a.media_fname)
+                try:
+                    _dispatch_event(addr, event)
+                except QueueFullError as e:
+                    return str(e), 429 if event.level < 30 else 503, {
+                        'Retry-After': str(e.retry_after)
+                    }
                 return _response_accepted()
             except:
                 log_traceback()
                 return '', 503
 
+    @ns_public.route('/push/batch')
+    class PushBatch(Resource):
+
+        method_decorators = [public_method]
+
+        @api.response(
+            200, 'batch processed, list of per-event results returned. '
+            'Each result contains "code" (HTTP status code of the event) and '
+            '"event_id" if accepted or "error" if failed ("retry_after" is '
+            'additionally set if dispatch queue is full)')
+        @api.response(400, 'invalid batch')
+        @api.response(413, 'batch is too large')
+        @api.response(503, 'server error')
+        def post(self):
+            """
+            Push multiple event messages
+
+            Request body: JSON array of push events or NDJSON (one event per
+            line)
+            """
+            try:
+                limits = core_config['push-batch']
+                # the body is not read if its declared length is too large
+                if (request.content_length or 0) > limits['max-bytes'] or \
+                        len(request.get_data()) > limits['max-bytes']:
+                    return (f'batch is larger than {limits["max-bytes"]} '
+                            'bytes'), 413
+                try:
+                    items = _parse_push_batch(request.get_data())
+                except ValueError as e:
+                    return str(e), 400
+                if len(items) > limits['max-size']:
+                    return (f'batch has more than {limits["max-size"]} '
+                            'events'), 413
+                logger.info(f'API batch of {len(items)} messages')
+                result = [None] * len(items)
+                events = {}
+                for i, (item, size) in enumerate(items):
+                    try:
+                        a = _parse_push_item(item)
+                    except ValueError as e:
+                        result[i] = {'code': 400, 'error': str(e)}
+                        continue
+                    event = _format_event(a, str(uuid.uuid4()))
+                    events.setdefault(a.addr, []).append((i, event, size))
+                for a, addr_events in events.items():
+                    try:
+                        addr = addr_get_cached(a)
+                    except LookupError:
+                        logger.info(f'API no such address: {a}')
+                        _set_batch_result(result, addr_events, 404,
+                                          f'addr {a} not found')
+                        continue
+                    if addr['active'] < 1:
+                        _set_batch_result(result, addr_events, 406,
+                                          f'addr {a} is disabled')
+                        continue
+                    if is_use_limits():
+                        accepted = []
+                        # high-priority events are checked first to let them
+                        # use limit reserve
+                        for group in ([
+                                x for x in addr_events if x[1].level >= 30
+                        ], [x for x in addr_events if x[1].level < 30]):
+                            if not group:
+                                continue
+                            try:
+                                check_addr_limit(
+                                    addr,
+                                    level=min(x[1].level for x in group),
+                                    size=sum(x[2] for x in group),
+                                    count=len(group))
+                                accepted += group
+                            except OverlimitError as e:
+                                _set_batch_result(result, group, 429, str(e))
+                        addr_events = accepted
+                    for i, event, size in addr_events:
+                        try:
+                            _dispatch_event(addr, event)
+                            result[i] = {
+                                'code': 202,
+                                'event_id': event.event_id
+                            }
+                        except QueueFullError as e:
+                            result[i] = {
+                                'code': 429 if event.level < 30 else 503,
+                                'error': str(e),
+                                'retry_after': e.retry_after
+                            }
+                        except:
+                            log_traceback()
+                            result[i] = {'code': 503, 'error': 'server error'}
+                return jsonify(result)
+            except:
+                log_traceback()
+                return '', 503
+
     # v2 (RESTful)
     app.add_url_rule(f'{api_uri_rest}/core', 'test', test, methods=['GET'])
     app.add_url_rule(f'{api_uri_rest}/core',
@@ -600,6 +664,176 @@ def init():
                      methods=['POST'])
 
 
+_push_fields = {
+    'addr': None,
+    'sender': None,
+    'msg': '',
+    'subject': '',
+    'level': 'info',
+    'location': None,
+    'tag': None,
+    'keywords': None,
+    'expires': None,
+    'media': None,
+    'media_fname': None
+}
+
+# fields, which are not converted to string
+_push_fields_raw = {'level', 'expires'}
+
+
+def _push_request_payload():
+    """
+    Get push request arguments
+
+    JSON body is decoded once, query string and form arguments (if any)
+    override JSON fields.
+
+    Binary media can be sent as "media" file of multipart/form-data request,
+    or as the request body of any other content type (event arguments are
+    sent in query string then)
+
+    Returns:
+        tuple (arguments, binary media or None)
+    Raises:
+        ValueError: if JSON body is invalid
+    """
+    media = None
+    if request.is_json:
+        data = request.get_data()
+        try:
+            payload = json.loads(data) if data else {}
+        except ValueError:
+            raise ValueError('invalid JSON payload')
+        if not isinstance(payload, dict):
+            raise ValueError('JSON payload should be an object')
+    else:
+        payload = {}
+        if request.mimetype == 'multipart/form-data':
+            for k, f in request.files.items():
+                if k != 'media':
+                    raise ValueError(f'Unknown arguments: {k}')
+                # werkzeug spools large files to a temporary file
+                media = f.read()
+                if payload.get('media_fname') is None:
+                    payload['media_fname'] = f.filename
+        elif request.mimetype != 'application/x-www-form-urlencoded':
+            media = request.get_data(cache=False)
+    if request.args or request.form:
+        payload.update(request.values.items())
+    return payload, media or None
+
+
+def _parse_push_item(data):
+    """
+    Parse push event dict
+
+    Returns:
+        event arguments namespace
+    Raises:
+        ValueError: if event is invalid
+    """
+    if not isinstance(data, dict):
+        raise ValueError('event should be an object')
+    unknown = data.keys() - _push_fields.keys()
+    if unknown:
+        raise ValueError(f'Unknown arguments: {", ".join(sorted(unknown))}')
+    a = SimpleNamespace(**_push_fields)
+    for k, v in data.items():
+        if v is not None:
+            setattr(
+                a, k,
+                v if k in _push_fields_raw or isinstance(v, str) else str(v))
+    if a.addr is None:
+        raise ValueError('addr: recipient address')
+    return a
+
+
+def _parse_push_batch(data):
+    """
+    Parse push batch (JSON array or NDJSON)
+
+    Returns:
+        list of tuples (event, size), event is None if can not be decoded
+    Raises:
+        ValueError: if batch is invalid
+    """
+    try:
+        payload = json.loads(data)
+        if isinstance(payload, list):
+            return [(item, len(json.dumps(item))) for item in payload]
+        elif isinstance(payload, dict):
+            return [(payload, len(data))]
+        else:
+            raise ValueError('batch should be a JSON array or NDJSON')
+    except ValueError:
+        lines = [l for l in data.splitlines() if l.strip()]
+        if len(lines) < 2:
+            raise ValueError('batch should be a JSON array or NDJSON')
+    items = []
+    for line in lines:
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        items.append((item, len(line)))
+    return items
+
+
+def _set_batch_result(result, events, code, msg):
+    for i, event, size in events:
+        result[i] = {'code': code, 'error': msg}
+
+
+def _format_event(a, event_id, media=None):
+    """
+    Format event for plugins
+
+    Args:
+        a: push arguments namespace
+        event_id: event id
+        media: binary media (if not base64-encoded in arguments)
+    Returns:
+        Event object
+    """
+    # TODO: remove keywords when removing legacy
+    if a.keywords is not None:
+        a.tag = a.keywords
+    if media is not None:
+        # encoded lazily, for plugins which need it
+        a.media = None
+    elif a.media:
+        try:
+            media = base64.b64decode(a.media)
+        except:
+            a.media = None
+            logger.warning(f'API invalid media file, event {event_id}'
+                           f' message to {a.addr}')
+    if media is not None and a.media_fname and '/' in a.media_fname:
+        a.media_fname = a.media_fname.rsplit('/', 1)[-1]
+    return Event(event_id=event_id,
+                 addr=a.addr,
+                 msg=a.msg,
+                 subject=a.subject,
+                 level=convert_level(a.level),
+                 location=a.location,
+                 tag=a.tag,
+                 sender=a.sender,
+                 media=media,
+                 media_encoded=a.media,
+                 media_fname=a.media_fname)
+
+
+def _dispatch_event(addr, event):
+    dispatch(
+        event,
+        route(addr,
+              location=event.location,
+              tag=event.tag,
+              sender=event.sender,
+              level=event.level))
+
+
 def _accept_resource(resource):
     accept_list = [
         h.split(';', 1)[0].strip()
@@ -623,6 +857,7 @@ def test(**kwargs):
     if request.headers.get('X-Auth-Key',
                            kwargs.get('k')) == core_config['master']['key']:
         result['master'] = True
+        result['dispatcher'] = dispatcher_stats()
     return jsonify(result)
 
 
@@ -634,6 +869,8 @@ def r_core_cmd(cmd=None):
         core_cleanup()
     elif cmd == 'delete-everything':
         delete_everything()
+    elif cmd == 'replay-dead-letters':
+        return jsonify({'replayed': dead_letter_replay()})
     else:
         abort(405)
     return _response_empty()
@@ -743,6 +980,8 @@ def r_endpoint_list(a):
 def r_endpoint_get(a, ep):
     try:
         endpoint = _get_object_verify_addr(ep, a, endpoint_get)
+        endpoint['circuit_breaker'] = endpoint_circuit_state(
+            endpoint['id'], endpoint['config'])
         return jsonify(endpoint)
     except LookupError:
         return _response_not_found(f'endpoint {a}/{ep} not found')
@@ -0,0 +1,113 @@
+__author__ = 'Altertech, http://www.altertech.com/'
+__copyright__ = 'Copyright (C) 2018-2020 Altertech Group'
+__license__ = 'Apache License 2.0'
+__version__ = '2.0.45'
+
+import threading
+import time
+
+from .core import logger
+
+STATE_CLOSED = 'closed'
+STATE_OPEN = 'open'
+STATE_HALF_OPEN = 'half-open'
+
+
+class _Circuit:
+
+    __slots__ = ('failures', 'opened', 'probing')
+
+    def __init__(self):
+        self.failures = 0
+        self.opened = None
+        self.probing = None
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for delivery targets
+
+    Circuit is opened after "failures" sequential failures. Open circuit
+    rejects deliveries for reset_timeout seconds, then becomes half-open and
+    lets a single probe delivery go. Successful probe closes the circuit,
+    failed one opens it again. If the probe result is not reported within
+    reset_timeout, the next probe is allowed.
+
+    Only failing circuits are stored, closed circuits are removed.
+    """
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def _state(self, c):
+        if c.opened is None:
+            return STATE_CLOSED
+        elif time.monotonic() - c.opened < self.reset_timeout:
+            return STATE_OPEN
+        else:
+            return STATE_HALF_OPEN
+
+    def allow(self, *keys):
+        """
+        Check if delivery is allowed for all the keys
+
+        If the delivery is allowed as a half-open probe, its result MUST be
+        reported with success or failure
+        """
+        with self.lock:
+            now = time.monotonic()
+            probes = []
+            for key in keys:
+                c = self.circuits.get(key)
+                if c is None:
+                    continue
+                state = self._state(c)
+                if state == STATE_OPEN:
+                    return False
+                elif state == STATE_HALF_OPEN:
+                    if c.probing is not None and \
+                            now - c.probing < self.reset_timeout:
+                        return False
+                    probes.append(c)
+            for c in probes:
+                c.probing = now
+            return True
+
+    def success(self, *keys):
+        with self.lock:
+            for key in keys:
+                c = self.circuits.pop(key, None)
+                if c is not None and c.opened is not None:
+                    logger.info(f'CORE circuit {key} closed')
+
+    def reset(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.circuits.pop(key, None)
+
+    def failure(self, *keys):
+        with self.lock:
+            for key in keys:
+                c = self.circuits.setdefault(key, _Circuit())
+                c.failures += 1
+                if c.probing is not None or (c.opened is None and
+                                             c.failures >= self.failures):
+                    logger.warning(f'CORE circuit {key} opened')
+                    c.opened = time.monotonic()
+                    c.probing = None
+
+    def state(self, key):
+        """
+        Get circuit state
+
+        Returns:
+            dict with state and failures
+        """
+        with self.lock:
+            c = self.circuits.get(key)
+            if c is None:
+                return {'state': STATE_CLOSED, 'failures': 0}
+            return {'state': self._state(c), 'failures': c.failures}
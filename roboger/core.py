@@ -14,12 +14,17 @@ import sqlalchemy
 import signal
 import datetime
 import time
+import operator
+import math
+import random
+import asyncio
+import requests
 
 import pyaltt2.json as json
 
 from types import SimpleNamespace
+from collections import OrderedDict
 from flask import Flask, request
-from concurrent.futures import ThreadPoolExecutor
 
 from pathlib import Path
 
@@ -31,6 +36,9 @@ from pyaltt2.db import Database
 from netaddr import IPNetwork
 from functools import partial
 from hashlib import sha256
+from urllib.parse import urlsplit
+
+from .event import Event
 
 rs = ResourceStorage(mod='roboger')
 rq = partial(rs.get, resource_subdir='sql', ext='sql')
@@ -61,12 +69,51 @@ SERVER_CONFIG_SCHEMA = {
                     'type': 'object',
                     'properties': {
                         'period': {
-                            'type': 'string'
+                            'type': ['string', 'integer']
+                        },
+                        'window': {
+                            'type': 'string',
+                            'enum': ['fixed', 'sliding']
+                        },
+                        'backend': {
+                            'type': 'string',
+                            'enum': ['redis', 'mmap']
+                        },
+                        'mmap': {
+                            'type': 'object',
+                            'properties': {
+                                'path': {
+                                    'type': 'string'
+                                },
+                                'slots': {
+                                    'type': 'integer',
+                                    'minimum': 8
+                                }
+                            },
+                            'additionalProperties': False
                         },
                         'reserve': {
                             'type': 'integer',
                             'minimum': 1
                         },
+                        'lease': {
+                            'type': 'object',
+                            'properties': {
+                                'count': {
+                                    'type': 'integer',
+                                    'minimum': 1
+                                },
+                                'size': {
+                                    'type': 'integer',
+                                    'minimum': 1
+                                },
+                                'idle': {
+                                    'type': 'number',
+                                    'minimum': 0.1
+                                }
+                            },
+                            'additionalProperties': False
+                        },
                         'redis': {
                             'type': 'object',
                             'properties': {
@@ -92,6 +139,20 @@ SERVER_CONFIG_SCHEMA = {
                     },
                     'additionalProperties': False
                 },
+                'push-batch': {
+                    'type': 'object',
+                    'properties': {
+                        'max-size': {
+                            'type': 'integer',
+                            'minimum': 1
+                        },
+                        'max-bytes': {
+                            'type': 'integer',
+                            'minimum': 1
+                        }
+                    },
+                    'additionalProperties': False
+                },
                 'secure-mode': {
                     'type': 'boolean'
                 },
@@ -103,10 +164,161 @@ SERVER_CONFIG_SCHEMA = {
                     'type': 'integer',
                     'minimum': 1
                 },
+                'core-pool-size': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
                 'timeout': {
                     'type': 'number',
                     'minimum': 0.1
                 },
+                'addr-cache': {
+                    'type': 'object',
+                    'properties': {
+                        'ttl': {
+                            'type': 'number',
+                            'minimum': 0
+                        },
+                        'negative-ttl': {
+                            'type': 'number',
+                            'minimum': 0
+                        },
+                        'size': {
+                            'type': 'integer',
+                            'minimum': 1
+                        }
+                    },
+                    'additionalProperties': False
+                },
+                'endpoint-cache': {
+                    'type': 'object',
+                    'properties': {
+                        'size': {
+                            'type': 'integer',
+                            'minimum': 1
+                        }
+                    },
+                    'additionalProperties': False
+                },
+                'cache-invalidation': {
+                    'type': 'object',
+                    'properties': {
+                        'channel': {
+                            'type': 'string'
+                        },
+                        'redis': {
+                            'type': 'object',
+                            'properties': {
+                                'host': {
+                                    'type': 'string',
+                                },
+                                'db': {
+                                    'type': 'integer',
+                                    'minimum': 0
+                                }
+                            },
+                            'additionalProperties': False,
+                        }
+                    },
+                    'additionalProperties': False
+                },
+                'circuit-breaker': {
+                    'type': 'object',
+                    'properties': {
+                        'enabled': {
+                            'type': 'boolean'
+                        },
+                        'failures': {
+                            'type': 'integer',
+                            'minimum': 1
+                        },
+                        'reset-timeout': {
+                            'type': 'number',
+                            'minimum': 0
+                        }
+                    },
+                    'additionalProperties': False
+                },
+                'http-pool': {
+                    'type': 'object',
+                    'properties': {
+                        'max-connections-per-host': {
+                            'type': 'integer',
+                            'minimum': 1
+                        },
+                        'idle-timeout': {
+                            'type': 'number',
+                            'minimum': 0.1
+                        },
+                        'async': {
+                            'type': 'boolean'
+                        }
+                    },
+                    'additionalProperties': False
+                },
+                'queue': {
+                    'type': 'object',
+                    'properties': {
+                        'max-size': {
+                            'type': 'integer',
+                            'minimum': 1
+                        },
+                        'max-bytes': {
+                            'type': 'integer',
+                            'minimum': 1
+                        },
+                        'reserve': {
+                            'type': 'integer',
+                            'minimum': 0,
+                            'maximum': 99
+                        },
+                        'aging': {
+                            'type': 'number',
+                            'minimum': 0
+                        },
+                        'max-wait': {
+                            'type': 'number',
+                            'minimum': 0
+                        },
+                        'reserved-workers': {
+                            'type': 'integer',
+                            'minimum': 0
+                        }
+                    },
+                    'additionalProperties': False
+                },
+                'spool': {
+                    'type': 'object',
+                    'properties': {
+                        'dir': {
+                            'type': 'string'
+                        },
+                        'segment-size': {
+                            'type': 'integer',
+                            'minimum': 1
+                        },
+                        'commit-delay': {
+                            'type': 'number',
+                            'minimum': 0
+                        }
+                    },
+                    'additionalProperties': False,
+                    'required': ['dir']
+                },
+                'routing-index': {
+                    'type': 'object',
+                    'properties': {
+                        'ttl': {
+                            'type': 'number',
+                            'minimum': 0
+                        },
+                        'size': {
+                            'type': 'integer',
+                            'minimum': 1
+                        }
+                    },
+                    'additionalProperties': False
+                },
                 'master': {
                     'type': 'object',
                     'properties': {
@@ -132,6 +344,82 @@ SERVER_CONFIG_SCHEMA = {
                             },
                             'config': {
                                 'type': 'object'
+                            },
+                            'pool': {
+                                'type': 'object',
+                                'properties': {
+                                    'size': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    },
+                                    'max-size': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    },
+                                    'max-bytes': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    },
+                                    'reserve': {
+                                        'type': 'integer',
+                                        'minimum': 0,
+                                        'maximum': 99
+                                    },
+                                    'aging': {
+                                        'type': 'number',
+                                        'minimum': 0
+                                    },
+                                    'max-wait': {
+                                        'type': 'number',
+                                        'minimum': 0
+                                    },
+                                    'reserved-workers': {
+                                        'type': 'integer',
+                                        'minimum': 0
+                                    }
+                                },
+                                'additionalProperties': False
+                            },
+                            'retry': {
+                                'type': 'object',
+                                'properties': {
+                                    'max-attempts': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    },
+                                    'delay': {
+                                        'type': 'number',
+                                        'minimum': 0
+                                    },
+                                    'max-delay': {
+                                        'type': 'number',
+                                        'minimum': 0
+                                    },
+                                    'multiplier': {
+                                        'type': 'number',
+                                        'minimum': 1
+                                    },
+                                    'jitter': {
+                                        'type': 'number',
+                                        'minimum': 0,
+                                        'maximum': 1
+                                    }
+                                },
+                                'additionalProperties': False
+                            },
+                            'batch': {
+                                'type': 'object',
+                                'properties': {
+                                    'window': {
+                                        'type': 'number',
+                                        'minimum': 0
+                                    },
+                                    'max-size': {
+                                        'type': 'integer',
+                                        'minimum': 1
+                                    }
+                                },
+                                'additionalProperties': False
                             }
                         },
                         'additionalProperties': False,
@@ -159,7 +447,40 @@ _d = SimpleNamespace(db=None,
                      ip_header=None,
                      log_tracebacks=False,
                      limits=None,
-                     redis_conn=None)
+                     redis_conn=None,
+                     route_index=None,
+                     routes=OrderedDict(),
+                     route_generation=0,
+                     route_lock=threading.Lock(),
+                     spool=None,
+                     plugin_pools={},
+                     batchers={},
+                     loop=None,
+                     loop_lock=threading.Lock(),
+                     aiohttp_session=None,
+                     http_sessions={},
+                     http_lock=threading.Lock(),
+                     timer=None,
+                     retry={},
+                     breaker=None,
+                     limits_period=None,
+                     limits_script=None,
+                     limits_lease=None,
+                     limits_leases={},
+                     limits_returns=[],
+                     limits_lock=threading.Lock(),
+                     limiter=None,
+                     addr_cache=None,
+                     addrs=OrderedDict(),
+                     addr_ids={},
+                     addr_generation=0,
+                     addr_lock=threading.Lock(),
+                     endpoints=OrderedDict(),
+                     endpoint_cache_size=None,
+                     endpoint_generation=0,
+                     endpoint_lock=threading.Lock(),
+                     invalidation_redis=None,
+                     invalidation_channel=None)
 
 config = {}
 plugins = {}
@@ -173,15 +494,87 @@ db_lock = threading.RLock()
 
 default_bucket_expires = 86400
 
+default_push_batch_max_size = 1000
+
+default_push_batch_max_bytes = 16777216
+
 logger = logging.getLogger('gunicorn.error')
 #logging.getLogger('roboger')
 
 default_timeout = 5
 
+default_limits_period = 'day'
+
+default_limits_reserve = 10
+
+default_limits_lease_count = 10
+
+default_limits_lease_size = 100000
+
+default_limits_lease_idle = 1
+
+default_limits_mmap_path = '/tmp/roboger-limits'
+
+default_limits_mmap_slots = 65536
+
 default_db_pool_size = 1
 
 default_thread_pool_size = 10
 
+default_core_pool_size = 2
+
+default_async_pool_size = 1000
+
+default_http_max_connections_per_host = 10
+
+default_http_idle_timeout = 30
+
+default_circuit_breaker_failures = 5
+
+default_circuit_breaker_reset_timeout = 30
+
+default_retry = {
+    'max-attempts': 3,
+    'delay': 1,
+    'max-delay': 60,
+    'multiplier': 2,
+    'jitter': 0.2
+}
+
+default_batch_window = 0.1
+
+default_batch_max_size = 100
+
+default_queue_max_size = 10000
+
+default_queue_max_bytes = 268435456
+
+default_queue_reserve = 10
+
+default_queue_aging = 1
+
+default_queue_max_wait = 10
+
+default_queue_reserved_workers = 1
+
+default_route_index_ttl = 5
+
+default_route_index_size = 10000
+
+default_addr_cache_ttl = 5
+
+default_addr_cache_negative_ttl = 5
+
+default_addr_cache_size = 10000
+
+default_endpoint_cache_size = 10000
+
+default_invalidation_channel = 'roboger.invalidate'
+
+default_spool_segment_size = 16 * 1024 * 1024
+
+default_spool_commit_delay = 0.002
+
 app = Flask('roboger')
 
 g = threading.local()
@@ -193,11 +586,40 @@ emoji_code = {
     50: u'\U0001F170'
 }
 
+_level_match = {
+    'e': operator.eq,
+    'g': operator.lt,
+    'ge': operator.le,
+    'l': operator.gt,
+    'le': operator.ge
+}
+
 
 class OverlimitError(Exception):
     pass
 
 
+class CircuitOpenError(Exception):
+    pass
+
+
+class HTTPStatusError(RuntimeError):
+    """
+    Raised by plugins, when the target server returns unsuccessful HTTP status
+    """
+
+    def __init__(self, *args, status=None):
+        super().__init__(*args)
+        self.status = status
+
+
+class QueueFullError(Exception):
+
+    def __init__(self, *args, retry_after=None):
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
 def set_build(build):
     product.build = build
     product.user_agent = 'Roboger/{} (v{} build {})'.format(
@@ -257,6 +679,14 @@ def load(fname=None):
                  config_path='/bucket/default-expires',
                  in_place=True,
                  default=default_bucket_expires)
+    config_value(config=config,
+                 config_path='/push-batch/max-size',
+                 in_place=True,
+                 default=default_push_batch_max_size)
+    config_value(config=config,
+                 config_path='/push-batch/max-bytes',
+                 in_place=True,
+                 default=default_push_batch_max_bytes)
     config_value(env='ROBOGER_DB',
                  config=config,
                  config_path='/db',
@@ -265,17 +695,33 @@ def load(fname=None):
     _d.log_tracebacks = config.get('log-tracebacks')
     _d.limits = config.get('limits')
     if _d.limits:
-        import redis
-        rhost, rport = parse_host_port(
-            _d.limits.get('redis', {}).get('host', 'localhost'), 6379)
-        rdb = _d.limits.get('redis', {}).get('db', 0)
-        _d.redis_conn = redis.Redis(host=rhost,
-                                    port=rport,
-                                    db=rdb,
-                                    socket_timeout=get_timeout(),
-                                    socket_keepalive=True)
-        logger.info(
-            f'CORE limits feature activated. Redis: {rhost}:{rport} db: {rdb}')
+        config_value(config=_d.limits,
+                     config_path='/period',
+                     in_place=True,
+                     default=default_limits_period)
+        config_value(config=_d.limits,
+                     config_path='/window',
+                     in_place=True,
+                     default='fixed')
+        config_value(config=_d.limits,
+                     config_path='/reserve',
+                     in_place=True,
+                     default=default_limits_reserve)
+        config_value(config=_d.limits,
+                     config_path='/backend',
+                     in_place=True,
+                     default='redis')
+        _d.limits_period = _parse_period(_d.limits['period'])
+        if _d.limits['backend'] == 'mmap':
+            from .limits import MmapLimiter
+            mmap_config = _d.limits.get('mmap', {})
+            path = mmap_config.get('path', default_limits_mmap_path)
+            _d.limiter = MmapLimiter(path,
+                                     slots=mmap_config.get(
+                                         'slots', default_limits_mmap_slots))
+            logger.info(f'CORE limits feature activated. Shared memory: {path}')
+        else:
+            _init_limits_redis()
     config['_acl'] = generate_netacl(config.get('master', {}).get('allow'),
                                      default=None)
     masterkey = os.getenv('ROBOGER_MASTERKEY')
@@ -285,6 +731,44 @@ def load(fname=None):
                  to_str=True,
                  in_place=True)
     _d.ip_header = config.get('ip-header')
+    _d.route_index = config.get('routing-index')
+    if _d.route_index is not None:
+        config_value(config=_d.route_index,
+                     config_path='/ttl',
+                     in_place=True,
+                     default=default_route_index_ttl)
+        config_value(config=_d.route_index,
+                     config_path='/size',
+                     in_place=True,
+                     default=default_route_index_size)
+        logger.info(f'CORE routing index activated, '
+                    f'ttl: {_d.route_index["ttl"]}, '
+                    f'size: {_d.route_index["size"]}')
+    _d.addr_cache = config.get('addr-cache')
+    if _d.addr_cache is not None:
+        config_value(config=_d.addr_cache,
+                     config_path='/ttl',
+                     in_place=True,
+                     default=default_addr_cache_ttl)
+        config_value(config=_d.addr_cache,
+                     config_path='/negative-ttl',
+                     in_place=True,
+                     default=default_addr_cache_negative_ttl)
+        config_value(config=_d.addr_cache,
+                     config_path='/size',
+                     in_place=True,
+                     default=default_addr_cache_size)
+        logger.info(f'CORE address cache activated, '
+                    f'ttl: {_d.addr_cache["ttl"]}, '
+                    f'negative ttl: {_d.addr_cache["negative-ttl"]}, '
+                    f'size: {_d.addr_cache["size"]}')
+    _d.endpoint_cache_size = config_value(
+        config=config,
+        config_path='/endpoint-cache/size',
+        default=default_endpoint_cache_size)
+    logger.debug(f'CORE endpoint cache size: {_d.endpoint_cache_size}')
+    if 'cache-invalidation' in config:
+        _init_cache_invalidation(config['cache-invalidation'])
 
     logger.debug('CORE initializing database')
     kw = {}
@@ -295,9 +779,25 @@ def load(fname=None):
     logger.debug(f'CORE database {_d.db} ({_d.db.name})')
     _d.db.connect()
     thread_pool_size = config.get('thread-pool-size', default_thread_pool_size)
-    logger.debug('CORE initializing thread pool for plugins '
-                 f'with max size {thread_pool_size}')
-    _d.pool = ThreadPoolExecutor(max_workers=thread_pool_size)
+    # core pool executes only background tasks (spawn)
+    core_pool_size = config.get('core-pool-size', default_core_pool_size)
+    logger.debug('CORE initializing core thread pool '
+                 f'with max size {core_pool_size}')
+    _d.pool = _create_dispatcher('core', core_pool_size,
+                                 {'reserved-workers': 0})
+    from .timer import TimerWheel
+    _d.timer = TimerWheel('retry_timer')
+    if is_http_async():
+        # fail early if aiohttp module is not installed
+        import aiohttp
+    breaker_config = config.get('circuit-breaker', {})
+    if breaker_config.get('enabled', False):
+        from .breaker import CircuitBreaker
+        _d.breaker = CircuitBreaker(
+            failures=breaker_config.get('failures',
+                                        default_circuit_breaker_failures),
+            reset_timeout=breaker_config.get(
+                'reset-timeout', default_circuit_breaker_reset_timeout))
     logger.debug('CORE initializing database')
     init_db()
     from . import api
@@ -319,15 +819,367 @@ def load(fname=None):
                 continue
         if _init_plugin(plugin_name, mod, plugin.get('config', {})):
             plugins[plugin_name] = mod
+            if hasattr(mod, 'send'):
+                _d.retry[plugin_name] = {
+                    **default_retry,
+                    **plugin.get('retry', {})
+                }
+                pool_config = plugin.get('pool', {})
+                if asyncio.iscoroutinefunction(mod.send):
+                    pool_size = pool_config.get('size',
+                                                default_async_pool_size)
+                    logger.debug(f'CORE initializing async pool for plugin '
+                                 f'{plugin_name} with max size {pool_size}')
+                    _d.plugin_pools[plugin_name] = _create_dispatcher(
+                        f'plugin.{plugin_name}',
+                        pool_size,
+                        pool_config,
+                        loop=get_loop())
+                else:
+                    pool_size = pool_config.get('size', thread_pool_size)
+                    logger.debug(f'CORE initializing thread pool for plugin '
+                                 f'{plugin_name} with max size {pool_size}')
+                    _d.plugin_pools[plugin_name] = _create_dispatcher(
+                        f'plugin.{plugin_name}', pool_size, pool_config)
+                if hasattr(mod, 'send_batch'):
+                    from .dispatcher import Batcher
+                    batch_config = plugin.get('batch', {})
+                    _d.batchers[plugin_name] = Batcher(
+                        f'plugin.{plugin_name}.batch',
+                        partial(_flush_batch, plugin_name),
+                        window=batch_config.get('window',
+                                                default_batch_window),
+                        max_size=batch_config.get('max-size',
+                                                  default_batch_max_size),
+                        timer=_d.timer)
             logger.info(f'CORE added plugin {plugin_name}')
+    if 'spool' in config:
+        _init_spool(config['spool'])
 
     logger.debug('CORE initialzation completed')
 
 
+def _init_limits_redis():
+    import redis
+    rhost, rport = parse_host_port(
+        _d.limits.get('redis', {}).get('host', 'localhost'), 6379)
+    rdb = _d.limits.get('redis', {}).get('db', 0)
+    _d.redis_conn = redis.Redis(host=rhost,
+                                port=rport,
+                                db=rdb,
+                                socket_timeout=get_timeout(),
+                                socket_keepalive=True)
+    _d.limits_script = _d.redis_conn.register_script(_limits_lua)
+    if 'lease' in _d.limits:
+        _d.limits_lease = {
+            'count': default_limits_lease_count,
+            'size': default_limits_lease_size,
+            'idle': default_limits_lease_idle,
+            **_d.limits['lease']
+        }
+        threading.Thread(target=_limits_flusher,
+                         name='roboger_limits_flusher',
+                         daemon=True).start()
+        logger.info(f'CORE limits lease mode, chunk: '
+                    f'{_d.limits_lease["count"]} messages, '
+                    f'{_d.limits_lease["size"]} bytes')
+    logger.info(
+        f'CORE limits feature activated. Redis: {rhost}:{rport} db: {rdb}')
+
+
+def _init_cache_invalidation(inv_config):
+    import redis
+    rhost, rport = parse_host_port(
+        inv_config.get('redis', {}).get('host', 'localhost'), 6379)
+    rdb = inv_config.get('redis', {}).get('db', 0)
+    _d.invalidation_redis = redis.Redis(host=rhost,
+                                        port=rport,
+                                        db=rdb,
+                                        socket_timeout=get_timeout(),
+                                        socket_keepalive=True)
+    _d.invalidation_channel = inv_config.get('channel',
+                                             default_invalidation_channel)
+    threading.Thread(target=_invalidation_listener,
+                     name='roboger_invalidation_listener',
+                     daemon=True).start()
+    logger.info(f'CORE cache invalidation activated. Redis: {rhost}:{rport} '
+                f'db: {rdb}, channel: {_d.invalidation_channel}')
+
+
+def _invalidation_listener():
+    """
+    Receives cache invalidation messages from other workers
+    """
+    while True:
+        try:
+            pubsub = _d.invalidation_redis.pubsub(
+                ignore_subscribe_messages=True)
+            pubsub.subscribe(_d.invalidation_channel)
+            # caches may be outdated while disconnected
+            _route_index_clear(notify=False)
+            _addr_cache_clear(notify=False)
+            _endpoint_cache_clear(notify=False)
+            while True:
+                message = pubsub.get_message(timeout=get_timeout())
+                if message is not None:
+                    _invalidate(json.loads(message['data']))
+        except Exception as e:
+            logger.error(f'CORE cache invalidation listener error: {e}')
+            log_traceback()
+            time.sleep(get_timeout())
+
+
+def _invalidate(message):
+    cache = message.get('c')
+    if cache == 'route':
+        if message.get('clear'):
+            _route_index_clear(notify=False)
+        else:
+            _route_index_drop(message.get('id'), notify=False)
+    elif cache == 'addr':
+        if message.get('clear'):
+            _addr_cache_clear(notify=False)
+        else:
+            _addr_cache_drop(addr_id=message.get('id'),
+                             addr=message.get('a'),
+                             notify=False)
+    elif cache == 'endpoint':
+        if message.get('clear'):
+            _endpoint_cache_clear(notify=False)
+        else:
+            _endpoint_cache_drop(endpoint_id=message.get('id'),
+                                 addr_id=message.get('addr_id'),
+                                 notify=False)
+
+
+def _notify_invalidation(**kwargs):
+    if _d.invalidation_channel:
+        try:
+            _d.invalidation_redis.publish(_d.invalidation_channel,
+                                          json.dumps(kwargs))
+        except Exception as e:
+            logger.error(f'CORE unable to publish cache invalidation: {e}')
+            log_traceback()
+
+
+def _create_dispatcher(name, workers, pool_config={}, loop=None):
+    from .dispatcher import Dispatcher, AsyncDispatcher
+    # missing pool options are taken from the global queue config
+    queue_config = {**config.get('queue', {}), **pool_config}
+    kw = dict(max_size=queue_config.get('max-size', default_queue_max_size),
+              max_bytes=queue_config.get('max-bytes', default_queue_max_bytes),
+              reserve=queue_config.get('reserve', default_queue_reserve),
+              aging=queue_config.get('aging', default_queue_aging),
+              max_wait=queue_config.get('max-wait', default_queue_max_wait),
+              reserved_workers=queue_config.get(
+                  'reserved-workers', default_queue_reserved_workers))
+    if loop:
+        return AsyncDispatcher(name, workers=workers, loop=loop, **kw)
+    else:
+        return Dispatcher(name, workers=workers, **kw)
+
+
+def get_loop():
+    """
+    Get core asyncio loop, started in a dedicated thread
+    """
+    with _d.loop_lock:
+        if _d.loop is None:
+            _d.loop = asyncio.new_event_loop()
+            threading.Thread(target=_d.loop.run_forever,
+                             name='roboger_loop',
+                             daemon=True).start()
+            logger.debug('CORE asyncio loop started')
+        return _d.loop
+
+
+def _http_pool_config():
+    http_pool = config.get('http-pool', {})
+    return (http_pool.get('max-connections-per-host',
+                          default_http_max_connections_per_host),
+            http_pool.get('idle-timeout', default_http_idle_timeout))
+
+
+def get_aiohttp_session():
+    """
+    Get shared aiohttp client session
+
+    Should be called from coroutines, running in the core loop only
+    """
+    if _d.aiohttp_session is None:
+        import aiohttp
+        max_conn, idle_timeout = _http_pool_config()
+        _d.aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0,
+                                           limit_per_host=max_conn,
+                                           keepalive_timeout=idle_timeout),
+            timeout=aiohttp.ClientTimeout(total=get_timeout()))
+    return _d.aiohttp_session
+
+
+def get_http_session(url):
+    """
+    Get shared keep-alive requests session for the URL host
+
+    Sessions are kept per host (scheme, host and port), connections are
+    reused until the session is idle for more than http-pool/idle-timeout
+    seconds.
+
+    Args:
+        url: request URL
+    Returns:
+        requests.Session object
+    """
+    p = urlsplit(url)
+    key = (p.scheme, p.netloc)
+    max_conn, idle_timeout = _http_pool_config()
+    now = time.monotonic()
+    with _d.http_lock:
+        try:
+            session, last_used = _d.http_sessions[key]
+            if now - last_used > idle_timeout:
+                session.close()
+                raise KeyError
+        except KeyError:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=max_conn)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['User-Agent'] = product.user_agent
+        _d.http_sessions[key] = (session, now)
+    return session
+
+
+def _http_session_cleanup():
+    _, idle_timeout = _http_pool_config()
+    now = time.monotonic()
+    with _d.http_lock:
+        for key, (session, last_used) in list(_d.http_sessions.items()):
+            if now - last_used > idle_timeout:
+                session.close()
+                del _d.http_sessions[key]
+
+
+def is_http_async():
+    """
+    Check if HTTP plugins send requests with aiohttp in the core loop
+    (http-pool/async)
+    """
+    return config.get('http-pool', {}).get('async', False)
+
+
+def http_post(url, reply=False, **kwargs):
+    """
+    Send HTTP/POST request with the shared keep-alive session
+
+    Args:
+        url: request URL
+        reply: if True, JSON reply is returned
+        other kwargs: passed to requests as-is (data, json, headers)
+    Raises:
+        HTTPStatusError: if the server returns unsuccessful status
+    """
+    r = get_http_session(url).post(url, timeout=get_timeout(), **kwargs)
+    if not r.ok:
+        raise HTTPStatusError(f'server {url} status {r.status_code}',
+                              status=r.status_code)
+    if reply:
+        return r.json()
+
+
+async def http_post_async(url, reply=False, **kwargs):
+    """
+    Send HTTP/POST request with the shared aiohttp session
+
+    Same as http_post, should be called from coroutines, running in the core
+    loop only
+    """
+    kwargs['headers'] = {
+        'User-Agent': product.user_agent,
+        **kwargs.get('headers', {})
+    }
+    async with get_aiohttp_session().post(url, **kwargs) as r:
+        if not r.ok:
+            raise HTTPStatusError(f'server {url} status {r.status}',
+                                  status=r.status)
+        if reply:
+            return await r.json()
+
+
+def http_sender(prepare):
+    """
+    Create "send" method for HTTP/POST plugin
+
+    Args:
+        prepare: function, which gets send kwargs and returns request URL and
+            dict of request kwargs (data, json, headers)
+    Returns:
+        coroutine function if http-pool/async is enabled, regular function
+        otherwise
+    """
+    if is_http_async():
+
+        async def send(**kwargs):
+            url, request_kwargs = prepare(**kwargs)
+            await http_post_async(url, **request_kwargs)
+
+    else:
+
+        def send(**kwargs):
+            url, request_kwargs = prepare(**kwargs)
+            http_post(url, **request_kwargs)
+
+    return send
+
+
+def _init_spool(spool_config):
+    from .spool import Spool
+    _d.spool = Spool(spool_config['dir'],
+                     segment_size=spool_config.get('segment-size',
+                                                   default_spool_segment_size),
+                     commit_delay=spool_config.get('commit-delay',
+                                                   default_spool_commit_delay))
+    replay = _d.spool.open()
+    logger.info(f'CORE spool activated, slot: {_d.spool.slot}')
+    if replay:
+        logger.warning(f'CORE replaying {len(replay)} spooled event(s)')
+    for data, targets in replay:
+        try:
+            event = Event.from_dict(data)
+            _dispatch(event, [
+                SimpleNamespace(plugin_name=plugin_name,
+                                endpoint_id=endpoint_id,
+                                addr_id=addr_id,
+                                config=config,
+                                prepared=_endpoint_prepare(
+                                    plugin_name, config))
+                for plugin_name, endpoint_id, addr_id, config in targets
+            ],
+                      _spool_ack_countdown(event.event_id, len(targets)),
+                      limited=False)
+        except:
+            logger.error(
+                f'CORE unable to replay event {data.get("event_id")}')
+            log_traceback()
+
+
 def spawn(*args, **kwargs):
     return _d.pool.submit(*args, **kwargs)
 
 
+def dispatcher_stats():
+    return {
+        'core': _d.pool.stats(),
+        'plugins': {
+            k: {
+                **v.stats(), 'batched':
+                    _d.batchers[k].pending() if k in _d.batchers else None
+            } for k, v in _d.plugin_pools.items()
+        }
+    }
+
+
 def init_db():
     from sqlalchemy import (Table, Column, BigInteger, Integer, Numeric, CHAR,
                             VARCHAR, MetaData, Float, ForeignKey, Index, JSON,
@@ -438,6 +1290,28 @@ def init_db():
                    Column('content', LargeBinary, nullable=False),
                    mysql_engine='InnoDB',
                    mysql_charset='utf8mb4')
+    dead_letter = Table('dead_letter',
+                        meta,
+                        Column('id',
+                               BigInteger().with_variant(Integer, 'sqlite'),
+                               primary_key=True,
+                               autoincrement=True),
+                        Column('addr_id',
+                               BigInteger().with_variant(Integer, 'sqlite'),
+                               ForeignKey('addr.id', ondelete='CASCADE')),
+                        Index('dead_letter_addr_id', 'addr_id'),
+                        Column('endpoint_id',
+                               BigInteger().with_variant(Integer, 'sqlite'),
+                               ForeignKey('endpoint.id', ondelete='CASCADE')),
+                        Index('dead_letter_endpoint_id', 'endpoint_id'),
+                        Column('plugin_name', VARCHAR(40), nullable=False),
+                        Column('config', JSON, nullable=False),
+                        Column('event', JSON, nullable=False),
+                        Column('attempts', Integer, nullable=False),
+                        Column('error', VARCHAR(255), nullable=True),
+                        Column('d', DateTime(timezone=True), nullable=False),
+                        mysql_engine='InnoDB',
+                        mysql_charset='utf8mb4')
     meta.create_all(_d.db.connect())
 
 
@@ -509,84 +1383,1077 @@ def convert_level(level):
 
 def send(plugin_name, **kwargs):
     try:
-        spawn(_safe_send, plugin_name, plugins[plugin_name].send, **kwargs)
+        send_func = plugins[plugin_name].send
+        _d.plugin_pools[plugin_name].submit(_get_safe_send(send_func),
+                                            plugin_name, send_func, None,
+                                            **kwargs)
     except KeyError:
         logger.warning(f'API no such plugin: {plugin_name}')
     except AttributeError:
         logger.warning(f'API no "send" method in plugin {plugin_name}')
 
 
-def _safe_send(plugin_name, send_func, event_id, **kwargs):
+def dispatch(event, targets):
+    """
+    Send event to targets
+
+    If spool is active, the event is written to spool before sending and
+    acknowledged when all targets are processed.
+
+    Args:
+        event: Event object
+        targets: list of targets, as returned by route
+    Raises:
+        QueueFullError: if dispatch queue is full
+    """
+    if not targets:
+        return
+    # capacity is reserved before the event is spooled
+    reservations = _reserve_capacity(event, targets)
+    try:
+        if _d.spool:
+            _d.spool.put(event.event_id, event.to_dict(),
+                         [[t.plugin_name, t.endpoint_id, t.addr_id, t.config]
+                          for t in targets])
+            done = _spool_ack_countdown(event.event_id, len(targets))
+        else:
+            done = None
+    except:
+        _release_capacity(reservations)
+        raise
+    _dispatch(event, targets, done, reservations=reservations)
+
+
+def _reserve_capacity(event, targets):
+    """
+    The event is accepted only if all plugin pools can accept its deliveries,
+    otherwise the whole event is rejected
+
+    Returns:
+        dict plugin name: pool capacity reservation
+    """
+    counts = {}
+    for target in targets:
+        if target.plugin_name in _d.plugin_pools:
+            counts[target.plugin_name] = counts.get(target.plugin_name, 0) + 1
+    size = event.size()
+    reservations = {}
+    for plugin_name, count in counts.items():
+        try:
+            reservations[plugin_name] = _d.plugin_pools[
+                plugin_name].reserve_capacity(count, size, event.level)
+        except QueueFullError as e:
+            logger.warning(f'CORE {event.event_id} rejected, '
+                           f'{plugin_name} pool: {e}')
+            _release_capacity(reservations)
+            raise
+    return reservations
+
+
+def _release_capacity(reservations):
+    for plugin_name, reservation in reservations.items():
+        _d.plugin_pools[plugin_name].release_capacity(reservation)
+
+
+def _dispatch(event, targets, done, limited=True, reservations=None):
+    """
+    Submit event deliveries to plugin pools
+
+    Args:
+        limited: if False, deliveries are submitted without capacity check
+        reservations: pool capacity reservations, as returned by
+            _reserve_capacity, committed or released by the function
+    """
+    if reservations is None:
+        reservations = {}
+    tasks = {}
+    for target in targets:
+        try:
+            plugin = plugins[target.plugin_name]
+            send_func = plugin.send
+        except KeyError:
+            logger.warning(f'API no such plugin: {target.plugin_name}')
+            if done: done()
+            continue
+        except AttributeError:
+            logger.warning(
+                f'API no "send" method in plugin {target.plugin_name}')
+            if done: done()
+            continue
+        kwargs = _delivery_kwargs(plugin,
+                                  event,
+                                  config=target.config,
+                                  prepared=target.prepared,
+                                  addr_id=target.addr_id,
+                                  endpoint_id=target.endpoint_id)
+        if not _circuit_allow(kwargs):
+            # fast-fail, the delivery is retried by the timer and moved to
+            # dead letters if the circuit is still open
+            kwargs.pop('event_id')
+            if not _send_failed(target.plugin_name, send_func, done,
+                                event.event_id, 1,
+                                CircuitOpenError('circuit is open'), kwargs):
+                if done: done()
+            continue
+        tasks.setdefault(target.plugin_name, []).append(
+            (_get_safe_send(send_func), (target.plugin_name, send_func,
+                                         done), kwargs))
+    size = event.size()
+    for plugin_name, plugin_tasks in tasks.items():
+        pool = _d.plugin_pools[plugin_name]
+        batcher = _d.batchers.get(plugin_name)
+        if batcher:
+            # deliveries are sent by the pool, when the batch is flushed
+            for _, (_, _, delivery_done), kwargs in plugin_tasks:
+                batcher.put(_target_host(kwargs['config']),
+                            (delivery_done, kwargs),
+                            urgent=event.level >= 40)
+        elif limited:
+            pool.submit_event(plugin_tasks,
+                              level=event.level,
+                              size=size,
+                              force=True,
+                              reservation=reservations.pop(plugin_name, None))
+        else:
+            for fn, args, kwargs in plugin_tasks:
+                pool.submit(fn, *args, _level=event.level, **kwargs)
+    # deliveries of the rest are batched or failed without sending
+    _release_capacity(reservations)
+
+
+def _flush_batch(plugin_name, host, deliveries):
+    # called by plugin batcher
+    plugin = plugins[plugin_name]
+    events = {id(kw['event']): kw['event'] for _, kw in deliveries}
+    _d.plugin_pools[plugin_name].submit_event(
+        [(_safe_send_batch_async
+          if asyncio.iscoroutinefunction(plugin.send_batch) else
+          _safe_send_batch, (plugin_name, plugin.send_batch, plugin.send,
+                             deliveries), {})],
+        level=max(e.level for e in events.values()),
+        size=sum(e.size() for e in events.values()),
+        force=True)
+
+
+def _safe_send_batch(plugin_name, send_batch, send_func, deliveries):
+    try:
+        logger.debug(f'CORE sending batch of {len(deliveries)} '
+                     f'deliveries via {plugin_name}')
+        results = send_batch([kwargs for _, kwargs in deliveries])
+    except Exception as e:
+        log_traceback()
+        results = [e] * len(deliveries)
+    _send_batch_done(plugin_name, send_func, deliveries, results)
+
+
+async def _safe_send_batch_async(plugin_name, send_batch, send_func,
+                                 deliveries):
+    try:
+        logger.debug(f'CORE sending batch of {len(deliveries)} '
+                     f'deliveries via {plugin_name} (async)')
+        results = await send_batch([kwargs for _, kwargs in deliveries])
+    except Exception as e:
+        log_traceback()
+        results = [e] * len(deliveries)
+    _send_batch_done(plugin_name, send_func, deliveries, results)
+
+
+def _send_batch_done(plugin_name, send_func, deliveries, results):
+    """
+    Process batch delivery results, failed deliveries are retried with the
+    plugin "send" method
+
+    A batch-level exception (the same object returned for several deliveries)
+    is reported to each circuit only once
+    """
+    if results is None:
+        results = [None] * len(deliveries)
+    elif len(results) != len(deliveries):
+        error = RuntimeError(f'plugin {plugin_name} returned '
+                             f'{len(results)} batch results instead of '
+                             f'{len(deliveries)}')
+        results = [error] * len(deliveries)
+    reported = set()
+    for (done, kwargs), result in zip(deliveries, results):
+        kwargs = kwargs.copy()
+        event_id = kwargs.pop('event_id')
+        try:
+            if isinstance(result, Exception):
+                _circuit_failure(kwargs, result, reported=reported)
+                if _send_failed(plugin_name, send_func, done, event_id, 1,
+                                result, kwargs):
+                    continue
+            else:
+                _circuit_success(kwargs)
+        except:
+            log_traceback()
+        if done: done()
+
+
+def _delivery_kwargs(plugin, event, **kwargs):
+    """
+    Get plugin send kwargs for the event delivery
+
+    Event fields are given to plugins as kwargs, the event object itself - as
+    "event"
+    """
+    kwargs.update(
+        event.kwargs(
+            media_encoded=getattr(plugin, 'need_media_encoded', True)))
+    kwargs['event'] = event
+    return kwargs
+
+
+def _spool_ack_countdown(event_id, count):
+    lock = threading.Lock()
+    pending = [count]
+
+    def done():
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        _d.spool.ack(event_id)
+
+    return done
+
+
+def _get_safe_send(send_func):
+    return _safe_send_async if asyncio.iscoroutinefunction(
+        send_func) else _safe_send
+
+
+def _safe_send(plugin_name,
+               send_func,
+               done,
+               event_id,
+               _attempt=1,
+               **kwargs):
     try:
         logger.debug(f'CORE {event_id} sending via {plugin_name}')
         send_func(event_id=event_id, **kwargs)
+        _circuit_success(kwargs)
+    except Exception as e:
+        _circuit_failure(kwargs, e)
+        if _send_failed(plugin_name, send_func, done, event_id, _attempt, e,
+                        kwargs):
+            return
+    if done: done()
+
+
+async def _safe_send_async(plugin_name,
+                           send_func,
+                           done,
+                           event_id,
+                           _attempt=1,
+                           **kwargs):
+    try:
+        logger.debug(f'CORE {event_id} sending via {plugin_name} (async)')
+        await send_func(event_id=event_id, **kwargs)
+        _circuit_success(kwargs)
+    except Exception as e:
+        _circuit_failure(kwargs, e)
+        if _send_failed(plugin_name, send_func, done, event_id, _attempt, e,
+                        kwargs):
+            return
+    if done: done()
+
+
+def _send_failed(plugin_name, send_func, done, event_id, attempt, error,
+                 kwargs):
+    """
+    Schedule delivery retry or put the delivery to dead letters
+
+    Args:
+        attempt: failed attempt number
+
+    Returns:
+        True if retry is scheduled or the delivery is being moved to dead
+        letters ("done" is called later)
+    """
+    try:
+        policy = _d.retry.get(plugin_name, default_retry)
+        if attempt is not None and attempt < policy['max-attempts']:
+            delay = min(policy['delay'] * policy['multiplier']**(attempt - 1),
+                        policy['max-delay'])
+            delay *= 1 + random.uniform(-policy['jitter'], policy['jitter'])
+            if isinstance(error, CircuitOpenError):
+                logger.warning(
+                    f'CORE {event_id} attempt {attempt} via {plugin_name} '
+                    f'failed: {error}, retrying in {delay:.3f} sec')
+            else:
+                logger.warning(
+                    f'CORE plugin {plugin_name} raised exception, '
+                    f'{event_id} attempt {attempt} failed, '
+                    f'retrying in {delay:.3f} sec')
+                log_traceback()
+            _d.timer.schedule(delay, _retry, plugin_name, send_func, done,
+                              event_id, attempt + 1, kwargs)
+            return True
+        if isinstance(error, CircuitOpenError):
+            logger.error(f'CORE {event_id} not sent via {plugin_name}: '
+                         f'{error}')
+        else:
+            logger.error(f'CORE plugin {plugin_name} raised exception, '
+                         f'{event_id} not sent')
+            log_traceback()
+        # the database is not queried in plugin workers and the asyncio loop
+        spawn(_dead_letter_put, plugin_name, event_id, attempt, error, kwargs,
+              done)
+        return True
     except:
-        logger.error(
-            f'CORE plugin {plugin_name} raised exception, {event_id} not sent')
         log_traceback()
+    return False
 
 
-def check_addr_limit(addr, level, size):
-    a = addr['id']
-    lim_c = addr['lim_c']
-    lim_s = addr['lim_s']
-    key_c = f'{a}.lim_c'
-    key_s = f'{a}.lim_s'
+def _dead_letter_put(plugin_name, event_id, attempts, error, kwargs, done):
+    # called by the core pool
     try:
+        dead_letter_put(plugin_name, event_id, attempts, error, kwargs)
+    except:
+        log_traceback()
+    if done: done()
+
+
+def _retry(plugin_name, send_func, done, event_id, attempt, kwargs):
+    # called by the timer
+    if _circuit_allow(kwargs):
+        _d.plugin_pools[plugin_name].submit(_get_safe_send(send_func),
+                                            plugin_name,
+                                            send_func,
+                                            done,
+                                            event_id,
+                                            _attempt=attempt,
+                                            _level=kwargs.get('level', 20),
+                                            **kwargs)
+    elif not _send_failed(plugin_name, send_func, done, event_id, attempt,
+                          CircuitOpenError('circuit is open'), kwargs):
+        if done: done()
+
+
+def _circuit_keys(kwargs, endpoint=True, host=True):
+    keys = []
+    endpoint_id = kwargs.get('endpoint_id') if endpoint else None
+    if endpoint_id is not None:
+        keys.append(f'endpoint:{endpoint_id}')
+    target_host = _target_host(kwargs.get('config')) if host else None
+    if target_host:
+        keys.append(f'host:{target_host}')
+    return keys
+
+
+def _circuit_allow(kwargs):
+    return _d.breaker is None or _d.breaker.allow(*_circuit_keys(kwargs))
+
+
+def _circuit_success(kwargs):
+    if _d.breaker is not None:
+        _d.breaker.success(*_circuit_keys(kwargs))
+
+
+def _circuit_failure(kwargs, error, reported=None):
+    """
+    Report delivery failure to circuit breaker
+
+    Outbound host circuits count only transport errors and 5xx HTTP statuses,
+    other errors are endpoint-specific (e.g. revoked web hook) and open only
+    the endpoint circuit
+
+    If "reported" set is specified, the error is counted once per circuit
+    """
+    if _d.breaker is None:
+        return
+    keys = _circuit_keys(kwargs, host=_is_host_error(error))
+    if reported is not None:
+        keys = [k for k in keys if (id(error), k) not in reported]
+        reported.update((id(error), k) for k in keys)
+    _d.breaker.failure(*keys)
+    if not _is_host_error(error):
+        # the host has replied
+        _d.breaker.success(*_circuit_keys(kwargs, endpoint=False))
+
+
+def _is_host_error(error):
+    if isinstance(error, HTTPStatusError):
+        return error.status is not None and error.status >= 500
+    if isinstance(error,
+                  (OSError, asyncio.TimeoutError, requests.ConnectionError,
+                   requests.Timeout)):
+        return True
+    aiohttp = sys.modules.get('aiohttp')
+    return aiohttp is not None and isinstance(error,
+                                              aiohttp.ClientConnectionError)
+
+
+def _target_host(config):
+    """
+    Get outbound host of endpoint config (if config has "url" field)
+    """
+    try:
+        return urlsplit(config['url']).netloc or None
+    except:
+        return None
+
+
+def endpoint_circuit_state(endpoint_id, config):
+    """
+    Get endpoint circuit breaker state (in the current worker)
+
+    Returns:
+        dict with endpoint and outbound host (if any) circuit states, None if
+        circuit breaker is disabled
+    """
+    if _d.breaker is None:
+        return None
+    result = {'endpoint': _d.breaker.state(f'endpoint:{endpoint_id}')}
+    for key in _circuit_keys({'config': config}):
+        result['host'] = _d.breaker.state(key)
+    return result
+
+
+def dead_letter_put(plugin_name, event_id, attempts, error, kwargs):
+    """
+    Put failed delivery to dead letters
+
+    Args:
+        plugin_name: plugin name
+        event_id: event id
+        attempts: delivery attempts made
+        error: the last delivery error
+        kwargs: plugin send kwargs
+    """
+    event = kwargs.get('event')
+    if event is None:
+        event = Event.from_dict(dict(kwargs, event_id=event_id))
+    event = event.to_dict()
+    if not _d.db.query(
+            'dead_letter.create',
+            plugin_name=plugin_name,
+            addr_id=kwargs.get('addr_id'),
+            endpoint_id=kwargs.get('endpoint_id'),
+            config=json.dumps(kwargs.get('config')),
+            event=json.dumps(event),
+            attempts=attempts,
+            error=str(error)[:255],
+            d=datetime.datetime.now()).rowcount:
+        # the endpoint has been deleted while the delivery was retried
+        logger.info(f'CORE {event_id} delivery via {plugin_name} dropped, '
+                    f'endpoint {kwargs.get("endpoint_id")} is deleted')
+        return
+    logger.info(f'CORE {event_id} delivery via {plugin_name} '
+                'moved to dead letters')
+
+
+def dead_letter_replay():
+    """
+    Replay dead letters
+
+    Deliveries are sent again with full retry policy and the current endpoint
+    config, and deleted from dead letters, when completed. Dead letters of
+    deleted and inactive endpoints are deleted without replaying.
+
+    Returns:
+        number of replayed deliveries
+    """
+    replayed = 0
+    for row in _d.db.qlist('dead_letter.list', json_fields=['event']):
+        try:
+            endpoint = _d.db.qlookup('endpoint.get', id=row['endpoint_id'])
+        except LookupError:
+            endpoint = None
+        if endpoint is None or not endpoint['active']:
+            logger.info(f'CORE dead letter {row["id"]} dropped, endpoint '
+                        f'{row["endpoint_id"]} is deleted or inactive')
+            _d.db.query('dead_letter.delete', id=row['id'])
+            continue
+        plugin_name = endpoint['plugin_name']
         try:
-            current_c = int(_d.redis_conn.get(key_c))
-        except TypeError:
-            current_c = 0
+            plugin = plugins[plugin_name]
+            send_func = plugin.send
+        except (KeyError, AttributeError):
+            logger.warning(f'CORE unable to replay dead letter {row["id"]}, '
+                           f'plugin {plugin_name} is not available')
+            continue
         try:
-            current_s = int(_d.redis_conn.get(key_s))
-        except TypeError:
-            current_s = 0
+            event = Event.from_dict(row['event'])
+            entry = _endpoint_get_cached(endpoint['id'], plugin_name,
+                                         endpoint['config'],
+                                         endpoint['addr_id'])
+            _d.plugin_pools[plugin_name].submit(
+                _get_safe_send(send_func),
+                plugin_name,
+                send_func,
+                partial(_d.db.query, 'dead_letter.delete', id=row['id']),
+                _level=event.level,
+                **_delivery_kwargs(plugin,
+                                   event,
+                                   config=entry.config,
+                                   prepared=entry.prepared,
+                                   addr_id=endpoint['addr_id'],
+                                   endpoint_id=endpoint['id']))
+            replayed += 1
+        except:
+            logger.error(f'CORE unable to replay dead letter {row["id"]}')
+            log_traceback()
+    logger.info(f'CORE {replayed} dead letter(s) replayed')
+    return replayed
+
+
+def route(addr, location=None, tag=None, sender=None, level=20):
+    """
+    Get event delivery targets
+
+    Args:
+        addr: address dict (as returned by addr_get)
+        location: event location
+        tag: event tag
+        sender: event sender
+        level: event level (integer)
+    Returns:
+        list of targets (endpoint_id, plugin_name, config, prepared,
+        addr_id), one per matching subscription
+    """
+    if _d.route_index is None:
+        return [
+            _endpoint_target(row.endpoint_id, row.plugin_name, row.config,
+                             row.addr_id)
+            for row in _d.db.query('push',
+                                   a=addr['a'],
+                                   location=location,
+                                   tag=tag,
+                                   sender=sender,
+                                   level=level)
+        ]
+    buckets = _route_index_get(addr['id'])
+    result = []
+    for loc in (location, None) if location is not None else (None,):
+        for t in (tag, None) if tag is not None else (None,):
+            for s in (sender, None) if sender is not None else (None,):
+                for sub_level, match, target in buckets.get((loc, t, s), ()):
+                    if match(sub_level, level):
+                        result.append(target)
+    return result
+
+
+def _endpoint_target(endpoint_id, plugin_name, config, addr_id):
+    entry = _endpoint_get_cached(endpoint_id, plugin_name, config, addr_id)
+    return SimpleNamespace(endpoint_id=endpoint_id,
+                           plugin_name=plugin_name,
+                           config=entry.config,
+                           prepared=entry.prepared,
+                           addr_id=addr_id)
+
+
+def _endpoint_get_cached(endpoint_id, plugin_name, config, addr_id=None):
+    """
+    Get parsed endpoint config and plugin-prepared data
+
+    Cache entry is versioned with endpoint config, as it is stored in the
+    database, so it is valid while the config is not changed (by this or any
+    other worker). The cache is limited to endpoint-cache/size entries, least
+    recently used entries are removed first.
+
+    Args:
+        endpoint_id: endpoint id
+        plugin_name: endpoint plugin
+        config: endpoint config, as returned by the database
+        addr_id: endpoint address id
+    """
+    with _d.endpoint_lock:
+        entry = _d.endpoints.get(endpoint_id)
+        if entry is not None and entry.version == config and \
+                entry.plugin_name == plugin_name:
+            _d.endpoints.move_to_end(endpoint_id)
+            return entry
+        generation = _d.endpoint_generation
+    parsed = json.loads(config) if is_parse_db_json() and isinstance(
+        config, str) else config
+    entry = SimpleNamespace(version=config,
+                            plugin_name=plugin_name,
+                            addr_id=addr_id,
+                            config=parsed,
+                            prepared=_endpoint_prepare(plugin_name, parsed))
+    with _d.endpoint_lock:
+        # don't store the entry if the cache has been modified while preparing
+        if generation == _d.endpoint_generation:
+            _d.endpoints[endpoint_id] = entry
+            _d.endpoints.move_to_end(endpoint_id)
+            while len(_d.endpoints) > _d.endpoint_cache_size:
+                _d.endpoints.popitem(last=False)
+    return entry
+
+
+def _endpoint_prepare(plugin_name, config):
+    """
+    Call plugin "prepare" method for endpoint config
+
+    Returns:
+        prepared data or None if plugin has no "prepare" method or it failed
+    """
+    plugin = plugins.get(plugin_name)
+    if plugin is None or not hasattr(plugin, 'prepare'):
+        return None
+    try:
+        return plugin.prepare(config)
+    except:
+        logger.error(f'CORE plugin {plugin_name} unable to prepare config')
+        log_traceback()
+        return None
+
+
+def _endpoint_cache_drop(endpoint_id=None, addr_id=None, notify=True):
+    with _d.endpoint_lock:
+        _d.endpoint_generation += 1
+        if endpoint_id is not None:
+            _d.endpoints.pop(int(endpoint_id), None)
+        if addr_id is not None:
+            for i in [
+                    i for i, entry in _d.endpoints.items()
+                    if entry.addr_id == int(addr_id)
+            ]:
+                del _d.endpoints[i]
+    if notify:
+        _notify_invalidation(c='endpoint', id=endpoint_id, addr_id=addr_id)
+
+
+def _endpoint_cache_clear(notify=True):
+    with _d.endpoint_lock:
+        _d.endpoint_generation += 1
+        _d.endpoints.clear()
+    if notify:
+        _notify_invalidation(c='endpoint', clear=True)
+
+
+def _route_index_get(addr_id):
+    with _d.route_lock:
+        entry = _d.routes.get(addr_id)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                _d.routes.move_to_end(addr_id)
+                return entry.buckets
+            del _d.routes[addr_id]
+        generation = _d.route_generation
+    targets = {}
+    buckets = {}
+    for row in _d.db.query('route', addr_id=addr_id):
+        target = targets.get(row.endpoint_id)
+        if target is None:
+            target = _endpoint_target(row.endpoint_id, row.plugin_name,
+                                      row.config, addr_id)
+            targets[row.endpoint_id] = target
+        buckets.setdefault((row.location, row.tag, row.sender), []).append(
+            (int(row.level), _level_match[row.level_match], target))
+    with _d.route_lock:
+        # don't store the entry if the index has been modified while loading
+        if generation == _d.route_generation:
+            _d.routes[addr_id] = SimpleNamespace(
+                buckets=buckets,
+                expires=time.monotonic() + _d.route_index['ttl'])
+            while len(_d.routes) > _d.route_index['size']:
+                _d.routes.popitem(last=False)
+    return buckets
+
+
+def _route_index_owner(addr_id=None,
+                       addr=None,
+                       endpoint_id=None,
+                       subscription_id=None):
+    """
+    Get address id of the object, returns None if routing index is not used
+    """
+    if _d.route_index is None:
+        return None
+    try:
+        if subscription_id is not None:
+            return subscription_get(subscription_id)['addr_id']
+        elif endpoint_id is not None:
+            return endpoint_get(endpoint_id)['addr_id']
+        elif addr_id is not None:
+            return int(addr_id)
+        else:
+            return addr_get(addr=addr)['id']
+    except LookupError:
+        return None
+
+
+def _route_index_drop(addr_id, notify=True):
+    if _d.route_index is not None and addr_id is not None:
+        with _d.route_lock:
+            _d.route_generation += 1
+            _d.routes.pop(addr_id, None)
+        if notify:
+            _notify_invalidation(c='route', id=addr_id)
+
+
+def _route_index_clear(notify=True):
+    if _d.route_index is not None:
+        with _d.route_lock:
+            _d.route_generation += 1
+            _d.routes.clear()
+        if notify:
+            _notify_invalidation(c='route', clear=True)
+
+
+def addr_get_cached(addr):
+    """
+    Get address by its string, using address cache (if enabled)
+
+    Unknown addresses are cached as well.
+
+    Raises:
+        LookupError: if address is not found
+    """
+    if _d.addr_cache is None:
+        return addr_get(addr=addr)
+    with _d.addr_lock:
+        entry = _d.addrs.get(addr)
+        if entry is not None:
+            if entry.expires > time.monotonic():
+                _d.addrs.move_to_end(addr)
+                if entry.record is None:
+                    raise LookupError(f'addr {addr} not found')
+                return entry.record
+            _addr_cache_pop(addr)
+        generation = _d.addr_generation
+    try:
+        record = addr_get(addr=addr)
+    except LookupError:
+        record = None
+    with _d.addr_lock:
+        # don't store the entry if the cache has been modified while loading
+        if generation == _d.addr_generation:
+            _d.addrs[addr] = SimpleNamespace(
+                record=record,
+                expires=time.monotonic() +
+                _d.addr_cache['ttl' if record else 'negative-ttl'])
+            if record is not None:
+                _d.addr_ids[record['id']] = addr
+            while len(_d.addrs) > _d.addr_cache['size']:
+                _addr_cache_pop(next(iter(_d.addrs)))
+    if record is None:
+        raise LookupError(f'addr {addr} not found')
+    return record
+
+
+def _addr_cache_pop(addr):
+    # called under address cache lock
+    entry = _d.addrs.pop(addr, None)
+    if entry is not None and entry.record is not None:
+        _d.addr_ids.pop(entry.record['id'], None)
+
+
+def _addr_cache_drop(addr_id=None, addr=None, notify=True):
+    if _d.addr_cache is not None:
+        with _d.addr_lock:
+            _d.addr_generation += 1
+            if addr_id is not None:
+                a = _d.addr_ids.get(int(addr_id))
+                if a is not None:
+                    _addr_cache_pop(a)
+            if addr is not None:
+                _addr_cache_pop(addr)
+    if notify:
+        _notify_invalidation(c='addr', id=addr_id, a=addr)
+
+
+def _addr_cache_clear(notify=True):
+    if _d.addr_cache is not None:
+        with _d.addr_lock:
+            _d.addr_generation += 1
+            _d.addrs.clear()
+            _d.addr_ids.clear()
+    if notify:
+        _notify_invalidation(c='addr', clear=True)
+
+
+_limit_periods = {'minute': 60, 'hour': 3600, 'day': 86400, 'week': 604800}
+
+# KEYS: count and size counters for the current and the previous window
+# ARGV: required count, required size, wanted count, wanted size, count limit,
+#       size limit, available share of limits, previous window weight,
+#       counter ttl
+# returns {0, granted count, granted size} if passed (counters are
+#       incremented by granted values) or {overlimit code, 0, 0}:
+#       1 - count, 2 - count (reserved), 3 - size, 4 - size (reserved)
+_limits_lua = """
+local need_c = tonumber(ARGV[1])
+local need_s = tonumber(ARGV[2])
+local want_c = tonumber(ARGV[3])
+local want_s = tonumber(ARGV[4])
+local lim_c = tonumber(ARGV[5])
+local lim_s = tonumber(ARGV[6])
+local k = tonumber(ARGV[7])
+local weight = tonumber(ARGV[8])
+local c = tonumber(redis.call('GET', KEYS[1]) or 0)
+local s = tonumber(redis.call('GET', KEYS[2]) or 0)
+if weight > 0 then
+    c = c + weight * tonumber(redis.call('GET', KEYS[3]) or 0)
+    s = s + weight * tonumber(redis.call('GET', KEYS[4]) or 0)
+end
+if c + need_c > lim_c then return {1, 0, 0} end
+if c + need_c > lim_c * k then return {2, 0, 0} end
+if s + need_s > lim_s then return {3, 0, 0} end
+if s + need_s > lim_s * k then return {4, 0, 0} end
+local grant_c = math.max(math.min(want_c, math.floor(lim_c * k - c)), need_c)
+local grant_s = math.max(math.min(want_s, math.floor(lim_s * k - s)), need_s)
+redis.call('INCRBY', KEYS[1], grant_c)
+redis.call('EXPIRE', KEYS[1], ARGV[9])
+redis.call('INCRBY', KEYS[2], grant_s)
+redis.call('EXPIRE', KEYS[2], ARGV[9])
+return {0, grant_c, grant_s}
+"""
+
+
+def _parse_period(period):
+    try:
+        return _limit_periods[period]
+    except KeyError:
+        try:
+            period = int(period)
+            if period <= 0:
+                raise ValueError
+            return period
+        except ValueError:
+            raise ValueError(f'invalid limits period: {period}')
+
+
+def _limits_window():
+    period = _d.limits_period
+    window, elapsed = divmod(time.time(), period)
+    if _d.limits['window'] == 'sliding':
+        return int(window), 1 - elapsed / period, period * 2
+    else:
+        return int(window), 0, period
+
+
+def _limits_keys(a, window):
+    return [
+        f'{a}.lim_c.{window}', f'{a}.lim_s.{window}',
+        f'{a}.lim_c.{window - 1}', f'{a}.lim_s.{window - 1}'
+    ]
+
+
+def _limits_acquire(addr, k, need_c, need_s, want_c, want_s):
+    """
+    Run limits script
+
+    Returns:
+        (window, granted count, granted size) or None if Redis failed
+    Raises:
+        OverlimitError: if limits are reached
+    """
+    window, weight, ttl = _limits_window()
+    if _d.limiter:
+        code = _d.limiter.acquire(addr['id'], window, weight, need_c, need_s,
+                                  int(addr['lim_c']), int(addr['lim_s']), k)
+        if code:
+            _raise_overlimit(addr, code)
+        return window, need_c, need_s
+    try:
+        code, grant_c, grant_s = _d.limits_script(
+            keys=_limits_keys(addr['id'], window),
+            args=[
+                need_c, need_s, want_c, want_s,
+                int(addr['lim_c']),
+                int(addr['lim_s']), k, weight,
+                math.ceil(ttl)
+            ])
     except Exception as e:
-        logger.error(f'CORE Redis error: {e}')
+        logger.error(f'CORE check limit error: {e}')
+        log_traceback()
+        return
+    if code:
+        _raise_overlimit(addr, code)
+    return window, grant_c, grant_s
+
+
+def check_addr_limit(addr, level, size, count=1):
+    """
+    Check address limits and count messages
+
+    Counters are checked and incremented atomically with Redis script. Fixed
+    window counters are reset every period, sliding window adds a part of the
+    previous window counters, proportional to the time left.
+
+    If limits lease is configured, the worker acquires limits in chunks and
+    checks messages locally, until the lease runs out.
+
+    Args:
+        addr: address dict (as returned by addr_get)
+        level: message level (for several messages: the lowest one)
+        size: message size (for several messages: total size)
+        count: number of messages
+    Raises:
+        OverlimitError: if limits are reached
+    """
+    k = (100 - _d.limits['reserve']) / 100 if level < 30 else 1
+    logger.debug(f'checking limits for addr.id={addr["id"]}, count: {count}, '
+                 f'size: {size}, current msg level: {level}')
+    if _d.limits_lease is None:
+        _limits_acquire(addr, k, count, size, count, size)
         return
-    logger.debug(f'checking limits for addr.id={a}, current: '
-                 f'{current_c}, size: {current_s}, current msg level: {level}')
+    key = (addr['id'], k)
+    window = _limits_window()[0]
+    with _d.limits_lock:
+        lease = _d.limits_leases.get(key)
+        if lease and lease.window == window and lease.count >= count and \
+                lease.size >= size:
+            lease.count -= count
+            lease.size -= size
+            lease.used = time.monotonic()
+            if not lease.refilling and \
+                    lease.count < _d.limits_lease['count'] / 2:
+                # acquire the next chunk in background
+                lease.refilling = True
+                spawn(_limits_refill, addr, k)
+            return
     try:
-        if current_c >= lim_c:
-            logger.info(
-                f'CORE address count overlimit addr.id={a} for all priorities')
-            raise OverlimitError(
-                f'Messages to {addr["a"]} are limited by {lim_c} per '
-                f'{_d.limits["period"]}. Limit has been reached')
-        elif current_c >= lim_c - (lim_c / 100 *
-                                   _d.limits['reserve']) and level < 30:
-            logger.info(
-                f'CORE address count overlimit addr.id={a} for low-priority')
-            raise OverlimitError(
-                f'Messages to {addr["a"]} are limited by {lim_c} per '
-                f'{_d.limits["period"]}, '
-                f'{_d.limits["reserve"]}% are reserved for '
-                'WARNING and higher levels')
-        if current_s >= lim_s + size:
-            logger.info(
-                f'CORE address size overlimit addr.id={a} for all priorities')
-            raise OverlimitError(
-                f'Messages to {addr["a"]} are limited by {lim_s} bytes per '
-                f'{_d.limits["period"]}. Limit has been reached')
-        elif current_s >= lim_s - (lim_s / 100 *
-                                   _d.limits['reserve']) and level < 30:
-            logger.info(
-                f'CORE address size overlimit addr.id={a} for low-priority')
-            raise OverlimitError(
-                f'Messages to {addr["a"]} are limited by {lim_s} bytes per '
-                f'{_d.limits["period"]}, '
-                f'{_d.limits["reserve"]}% are reserved for '
-                'WARNING and higher levels')
-        _d.redis_conn.incr(key_c)
-        _d.redis_conn.incr(key_s, size)
+        result = _limits_acquire(addr, k, count, size,
+                                 max(count, _d.limits_lease['count']),
+                                 max(size, _d.limits_lease['size']))
     except OverlimitError:
-        raise
+        # return unused leases of the address and check precisely
+        if not _limits_release(addr['id']):
+            raise
+        result = _limits_acquire(addr, k, count, size, count, size)
+    if result:
+        _limits_add_lease(key, *result, count, size)
+
+
+def _limits_refill(addr, k):
+    key = (addr['id'], k)
+    try:
+        result = _limits_acquire(addr, k, 0, 0, _d.limits_lease['count'],
+                                 _d.limits_lease['size'])
+    except OverlimitError:
+        result = None
+    if result:
+        _limits_add_lease(key, *result, 0, 0)
+    else:
+        with _d.limits_lock:
+            lease = _d.limits_leases.get(key)
+            if lease:
+                lease.refilling = False
+
+
+def _limits_add_lease(key, window, grant_c, grant_s, count, size):
+    with _d.limits_lock:
+        lease = _d.limits_leases.get(key)
+        if lease and lease.window == window:
+            lease.count += grant_c - count
+            lease.size += grant_s - size
+        else:
+            if lease:
+                _limits_return(key[0], lease)
+            lease = SimpleNamespace(window=window,
+                                    count=grant_c - count,
+                                    size=grant_s - size)
+            _d.limits_leases[key] = lease
+        lease.used = time.monotonic()
+        lease.refilling = False
+
+
+def _limits_return(a, lease):
+    # returns unused lease to Redis, called under limits lock
+    if lease.count or lease.size:
+        _d.limits_returns.append((a, lease.window, lease.count, lease.size))
+
+
+def _limits_release(a):
+    """
+    Returns unused leases of the address to Redis
+
+    Returns:
+        True if any lease has been returned
+    """
+    with _d.limits_lock:
+        for key in [key for key in _d.limits_leases if key[0] == a]:
+            _limits_return(a, _d.limits_leases.pop(key))
+        returns = [x for x in _d.limits_returns if x[0] == a]
+        _d.limits_returns = [x for x in _d.limits_returns if x[0] != a]
+    return _limits_flush_returns(returns)
+
+
+def _limits_flush_returns(returns):
+    if not returns:
+        return False
+    try:
+        pipe = _d.redis_conn.pipeline(transaction=False)
+        for a, window, count, size in returns:
+            keys = _limits_keys(a, window)
+            if count:
+                pipe.decrby(keys[0], count)
+            if size:
+                pipe.decrby(keys[1], size)
+        pipe.execute()
+        logger.debug(f'CORE {len(returns)} unused limit lease(s) returned')
+        return True
     except Exception as e:
-        logger.error(f'CORE check limit error: {e}')
+        logger.error(f'CORE unable to return limit leases: {e}')
         log_traceback()
+        return False
+
+
+def _limits_flusher():
+    """
+    Returns unused leases of idle addresses to Redis
+    """
+    while True:
+        time.sleep(_d.limits_lease['idle'])
+        now = time.monotonic()
+        window = _limits_window()[0]
+        with _d.limits_lock:
+            for key, lease in list(_d.limits_leases.items()):
+                if lease.window != window or \
+                        now - lease.used > _d.limits_lease['idle']:
+                    if lease.refilling:
+                        continue
+                    del _d.limits_leases[key]
+                    _limits_return(key[0], lease)
+            returns = _d.limits_returns
+            _d.limits_returns = []
+        _limits_flush_returns(returns)
+
+
+def _raise_overlimit(addr, code):
+    a = addr['id']
+    period = _d.limits['period']
+    if code == 1:
+        logger.info(
+            f'CORE address count overlimit addr.id={a} for all priorities')
+        raise OverlimitError(
+            f'Messages to {addr["a"]} are limited by {addr["lim_c"]} per '
+            f'{period}. Limit has been reached')
+    elif code == 2:
+        logger.info(
+            f'CORE address count overlimit addr.id={a} for low-priority')
+        raise OverlimitError(
+            f'Messages to {addr["a"]} are limited by {addr["lim_c"]} per '
+            f'{period}, {_d.limits["reserve"]}% are reserved for '
+            'WARNING and higher levels')
+    elif code == 3:
+        logger.info(
+            f'CORE address size overlimit addr.id={a} for all priorities')
+        raise OverlimitError(
+            f'Messages to {addr["a"]} are limited by {addr["lim_s"]} bytes '
+            f'per {period}. Limit has been reached')
+    else:
+        logger.info(
+            f'CORE address size overlimit addr.id={a} for low-priority')
+        raise OverlimitError(
+            f'Messages to {addr["a"]} are limited by {addr["lim_s"]} bytes '
+            f'per {period}, {_d.limits["reserve"]}% are reserved for '
+            'WARNING and higher levels')
 
 
 def reset_addr_limits():
+    if _d.limiter:
+        _d.limiter.reset()
+        logger.info('CORE address limits reset')
+        return
+    with _d.limits_lock:
+        _d.limits_leases.clear()
+        _d.limits_returns.clear()
     _d.redis_conn.flushdb()
     logger.info('CORE address limits reset')
 
@@ -594,6 +2461,7 @@ def reset_addr_limits():
 def cleanup():
     logger.debug('CORE cleanup')
     bucket_cleanup()
+    _http_session_cleanup()
     for k, v in plugins.items():
         safe_run_method(v, 'cleanup')
 
@@ -606,7 +2474,12 @@ def plugin_list():
 
 
 def delete_everything():
+    # dead letters are deleted explicitly, as sqlite doesn't cascade
+    _d.db.query('dead_letter.deleteall')
     _d.db.query('del')
+    _endpoint_cache_clear()
+    _route_index_clear()
+    _addr_cache_clear()
 
 
 def addr_get(addr_id=None, addr=None):
@@ -624,6 +2497,7 @@ def addr_list():
 def addr_create():
     addr = gen_random_str(64)
     i = _d.db.qcreate('addr.create', a=addr)
+    _addr_cache_drop(addr=addr)
     logger.debug(f'CORE created address {i} ({addr})')
     return i
 
@@ -631,8 +2505,12 @@ def addr_create():
 def addr_change(addr_id=None, addr=None, to=None):
     if to is None:
         to = gen_random_str(64)
+    owner = _route_index_owner(addr_id=addr_id, addr=addr)
     try:
         _d.db.query('addr.update.a', _cr=True, new_a=to, id=addr_id, a=addr)
+        _route_index_drop(owner)
+        _addr_cache_drop(addr_id=addr_id, addr=addr)
+        _addr_cache_drop(addr=to)
         return to
     except sqlalchemy.exc.IntegrityError:
         raise ValueError
@@ -644,6 +2522,8 @@ def addr_set_active(addr_id=None, addr=None, active=1):
                 active=active,
                 id=addr_id,
                 a=addr)
+    _route_index_drop(_route_index_owner(addr_id=addr_id, addr=addr))
+    _addr_cache_drop(addr_id=addr_id, addr=addr)
     return addr_get(addr_id=addr_id, addr=addr)
 
 
@@ -660,11 +2540,22 @@ def addr_set_limit(addr_id=None, addr=None, lim_c=None, lim_s=None):
                     lim_s=lim_s,
                     id=addr_id,
                     a=addr)
+    _addr_cache_drop(addr_id=addr_id, addr=addr)
     return addr_get(addr_id=addr_id, addr=addr)
 
 
 def addr_delete(addr_id=None, addr=None):
+    owner = _route_index_owner(addr_id=addr_id, addr=addr)
+    if addr_id is None:
+        try:
+            addr_id = addr_get(addr=addr)['id']
+        except LookupError:
+            pass
+    _d.db.query('dead_letter.deleteaddr', id=addr_id, a=addr)
     _d.db.query('addr.delete', _cr=True, id=addr_id, a=addr)
+    _route_index_drop(owner)
+    _addr_cache_drop(addr_id=addr_id, addr=addr)
+    _endpoint_cache_drop(addr_id=addr_id)
     logger.debug(f'CORE deleted address {addr_id}')
 
 
@@ -702,6 +2593,11 @@ def endpoint_create(plugin_name,
                       plugin=plugin_name,
                       config=json.dumps(config),
                       description=description)
+    _route_index_drop(_route_index_owner(addr_id=addr_id, addr=addr))
+    # endpoint id may be reused by the database
+    if _d.breaker is not None:
+        _d.breaker.reset(f'endpoint:{i}')
+    _endpoint_cache_drop(i)
     logger.debug(f'CORE created endpoint {i} (plugin: {plugin_name})')
     return i
 
@@ -733,18 +2629,26 @@ def endpoint_update(endpoint_id, data, validate_config=False, plugin_name=None):
     except:
         dbt.rollback()
         raise
+    _endpoint_cache_drop(endpoint_id)
+    _route_index_drop(_route_index_owner(endpoint_id=endpoint_id))
 
 
 def endpoint_delete(endpoint_id):
+    owner = _route_index_owner(endpoint_id=endpoint_id)
+    _d.db.query('dead_letter.deleteendpoint', id=endpoint_id)
     _d.db.query('endpoint.delete', _cr=True, id=endpoint_id)
+    _endpoint_cache_drop(endpoint_id)
+    _route_index_drop(owner)
     logger.debug(f'CORE deleted endpoint {endpoint_id}')
 
 
 def endpoint_delete_subscriptions(endpoint_id):
-    return _d.db.query(
+    result = _d.db.query(
         'endpoint.deletesub',
         id=endpoint_id,
     ).rowcount
+    _route_index_drop(_route_index_owner(endpoint_id=endpoint_id))
+    return result
 
 
 def subscription_get(subscription_id, endpoint_id=None):
@@ -786,6 +2690,7 @@ def subscription_create(endpoint_id,
                       sender=sender,
                       level=level,
                       level_match=level_match)
+    _route_index_drop(_route_index_owner(endpoint_id=endpoint_id))
     logger.debug(f'CORE created subscription {i} for endpoint {endpoint_id}')
     return i
 
@@ -813,10 +2718,13 @@ def subscription_update(subscription_id, data):
     except:
         dbt.rollback()
         raise
+    _route_index_drop(_route_index_owner(subscription_id=subscription_id))
 
 
 def subscription_delete(subscription_id):
+    owner = _route_index_owner(subscription_id=subscription_id)
     _d.db.query('subscription.delete', _cr=True, id=subscription_id)
+    _route_index_drop(owner)
     logger.debug(f'CORE deleted subscription {subscription_id}')
 
 
@@ -913,6 +2821,38 @@ def bucket_put(content,
     return object_id
 
 
+def event_media_put(event, creator, addr_id, public=True, expires=None):
+    """
+    Put event media into bucket
+
+    Media is stored once per event: the object is created on the first call,
+    the next calls (e.g. from other deliveries of the same event) get the same
+    object ID
+
+    Args:
+        event: event object
+        creator: object creator (if the object is created)
+        addr_id: object addr id (if the object is created)
+        public: object visibility (if the object is created)
+        expires: object expiration (if the object is created)
+    Returns:
+        bucket object ID or None if event has no media
+    """
+
+    def put(event):
+        ft = event.media_type
+        return bucket_put(
+            content=event.media,
+            creator=creator,
+            addr_id=addr_id,
+            mimetype=ft.mime if ft else None,
+            fname=event.media_fname if event.media_fname else None,
+            public=public,
+            expires=expires)
+
+    return event.media_object_id(put)
+
+
 def bucket_touch(object_id):
     """
     Mark object accessed (set access time)
@@ -0,0 +1,387 @@
+__author__ = 'Altertech, http://www.altertech.com/'
+__copyright__ = 'Copyright (C) 2018-2020 Altertech Group'
+__license__ = 'Apache License 2.0'
+__version__ = '2.0.45'
+
+import threading
+import time
+import math
+import heapq
+import itertools
+import asyncio
+
+from concurrent.futures import Future
+from functools import partial
+
+from .core import logger, log_traceback, QueueFullError
+
+
+class _Group:
+    """
+    Tasks, submitted together, share payload size, which is released when the
+    last task is completed
+    """
+
+    __slots__ = ('pending', 'size')
+
+    def __init__(self, pending, size):
+        self.pending = pending
+        self.size = size
+
+
+class _Reservation:
+    """
+    Queue capacity, reserved for event tasks before they are submitted
+    """
+
+    __slots__ = ('count', 'size')
+
+    def __init__(self, count, size):
+        self.count = count
+        self.size = size
+
+
+class Dispatcher:
+    """
+    Thread pool with bounded priority task queue
+
+    Queue is limited by task count and by payload size. Tasks of low-priority
+    events (level < 30) are shed, when queue usage reaches (100 - reserve)%,
+    the rest of the queue is reserved for WARNING and higher levels.
+
+    Tasks of ERROR and higher levels are always executed first. Other tasks
+    are executed in order of event level, their priority grows with waiting
+    time: each level step (10) gives the task the same priority as waiting for
+    "aging" seconds. To prevent starvation, low-priority tasks, waiting for
+    more than "max_wait" seconds, are executed before high-priority ones.
+    Reserved workers execute tasks of ERROR and higher levels only.
+
+    Capacity can be reserved for event tasks before they are submitted (e.g.
+    while the event is spooled), reserved capacity is counted as queued.
+    """
+
+    def __init__(self,
+                 name,
+                 workers,
+                 max_size=None,
+                 max_bytes=None,
+                 reserve=10,
+                 aging=1,
+                 max_wait=10,
+                 reserved_workers=1):
+        self.name = name
+        self.workers = workers
+        self.reserved_workers = reserved_workers
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.reserve = reserve
+        self.aging = aging
+        self.max_wait = max_wait
+        # tasks of ERROR and higher levels
+        self.queue_high = []
+        self.queue = []
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.cond_reserved = threading.Condition(self.lock)
+        self.bytes = 0
+        # reserved task count
+        self.reserved = 0
+        self.active = 0
+        self.processed = 0
+        self.shed = 0
+        self.rejected = 0
+        # average task duration (exponential moving average)
+        self.avg_duration = 0
+        self._start_workers()
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker,
+                             name=f'roboger_{self.name}_{i}',
+                             daemon=True).start()
+        for i in range(self.reserved_workers):
+            threading.Thread(target=self._worker,
+                             name=f'roboger_{self.name}_r{i}',
+                             args=(True,),
+                             daemon=True).start()
+
+    def submit(self, fn, *args, _level=20, **kwargs):
+        """
+        Submit task (not limited)
+
+        Args:
+            _level: task priority (event level, default: 20)
+
+        Returns:
+            concurrent.futures.Future object
+        """
+        future = Future()
+        with self.lock:
+            self._put((future, fn, args, kwargs, None), _level)
+        return future
+
+    def _put(self, task, level):
+        item = (time.monotonic() - level / 10 * self.aging, next(self.seq),
+                task)
+        if level >= 40:
+            heapq.heappush(self.queue_high, item)
+            self.cond_reserved.notify()
+        else:
+            heapq.heappush(self.queue, item)
+        self.cond.notify()
+
+    def _get(self, reserved):
+        if reserved:
+            while not self.queue_high:
+                self.cond_reserved.wait()
+            return heapq.heappop(self.queue_high)[2]
+        while not self.queue and not self.queue_high:
+            self.cond.wait()
+        if self.queue_high and (not self.queue or self.queue[0][0] >
+                                time.monotonic() - self.max_wait):
+            return heapq.heappop(self.queue_high)[2]
+        else:
+            return heapq.heappop(self.queue)[2]
+
+    def _queued(self):
+        return len(self.queue) + len(self.queue_high)
+
+    def submit_event(self, tasks, level, size, force=False, reservation=None):
+        """
+        Submit event tasks
+
+        Either all tasks are accepted or none
+
+        Args:
+            tasks: list of (fn, args, kwargs)
+            level: event level
+            size: event payload size
+            force: submit without capacity check (e.g. if reserved before)
+            reservation: capacity reservation (returned by reserve_capacity)
+                to commit
+        Raises:
+            QueueFullError: if the queue is full
+        """
+        with self.lock:
+            if reservation is not None:
+                self._release(reservation)
+            if not force:
+                self._check_capacity(len(tasks), size, level)
+            group = _Group(len(tasks), size)
+            self.bytes += size
+            for fn, args, kwargs in tasks:
+                self._put((None, fn, args, kwargs, group), level)
+
+    def reserve_capacity(self, count, size, level):
+        """
+        Reserve queue capacity for event tasks
+
+        The reservation MUST be either committed with submit_event or
+        released with release_capacity
+
+        Returns:
+            reservation object
+        Raises:
+            QueueFullError: if the queue is full
+        """
+        with self.lock:
+            self._check_capacity(count, size, level)
+            self.reserved += count
+            self.bytes += size
+            return _Reservation(count, size)
+
+    def release_capacity(self, reservation):
+        """
+        Release reserved queue capacity
+        """
+        with self.lock:
+            self._release(reservation)
+
+    def _release(self, reservation):
+        if reservation.count is not None:
+            self.reserved -= reservation.count
+            self.bytes -= reservation.size
+            # committed or released only once
+            reservation.count = None
+
+    def _check_capacity(self, count, size, level):
+        k = (100 - self.reserve) / 100 if level < 30 else 1
+        queued = self._queued() + self.reserved
+        if (self.max_size and queued + count > self.max_size * k) or \
+                (self.max_bytes and self.bytes + size > self.max_bytes * k):
+            if k < 1:
+                self.shed += 1
+                msg = 'dispatch queue is full for low-priority events'
+            else:
+                self.rejected += 1
+                msg = 'dispatch queue is full'
+            logger.warning(f'CORE {self.name} {msg}')
+            raise QueueFullError(msg, retry_after=self._retry_after())
+
+    def _retry_after(self):
+        return min(
+            max(math.ceil(self._queued() * self.avg_duration / self.workers),
+                1), 300)
+
+    def _worker(self, reserved=False):
+        while True:
+            with self.lock:
+                future, fn, args, kwargs, group = self._get(reserved)
+                self.active += 1
+            t_start = time.perf_counter()
+            if future is None:
+                try:
+                    fn(*args, **kwargs)
+                except:
+                    log_traceback()
+            elif future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except Exception as e:
+                    future.set_exception(e)
+            self._task_done(group, time.perf_counter() - t_start)
+
+    def _task_done(self, group, duration):
+        with self.lock:
+            self.active -= 1
+            self.processed += 1
+            self.avg_duration = self.avg_duration * 0.9 + duration * 0.1
+            if group is not None:
+                group.pending -= 1
+                if not group.pending:
+                    self.bytes -= group.size
+
+    def stats(self):
+        """
+        Get dispatcher stats
+        """
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'reserved_workers': self.reserved_workers,
+                'active': self.active,
+                'queued': self._queued(),
+                'queued_high': len(self.queue_high),
+                'queued_bytes': self.bytes,
+                'reserved': self.reserved,
+                'max_size': self.max_size,
+                'max_bytes': self.max_bytes,
+                'processed': self.processed,
+                'shed': self.shed,
+                'rejected': self.rejected
+            }
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    Dispatcher for coroutine tasks
+
+    Tasks are coroutine functions, which are executed in the asyncio loop,
+    "workers" is the max number of tasks running concurrently. The queue is
+    fed by a single thread, reserved workers are not used.
+    """
+
+    def __init__(self, name, workers, loop, **kwargs):
+        self.loop = loop
+        self.slots = threading.Semaphore(workers)
+        kwargs['reserved_workers'] = 0
+        super().__init__(name, workers, **kwargs)
+
+    def _start_workers(self):
+        threading.Thread(target=self._feeder,
+                         name=f'roboger_{self.name}_feeder',
+                         daemon=True).start()
+
+    def _feeder(self):
+        while True:
+            self.slots.acquire()
+            with self.lock:
+                future, fn, args, kwargs, group = self._get(False)
+                self.active += 1
+            if future is not None and \
+                    not future.set_running_or_notify_cancel():
+                self._coro_done(None, group, time.perf_counter(), None)
+                continue
+            try:
+                f = asyncio.run_coroutine_threadsafe(fn(*args, **kwargs),
+                                                     self.loop)
+            except Exception as e:
+                log_traceback()
+                if future is not None:
+                    future.set_exception(e)
+                self._coro_done(None, group, time.perf_counter(), None)
+                continue
+            f.add_done_callback(
+                partial(self._coro_done, future, group, time.perf_counter()))
+
+    def _coro_done(self, future, group, t_start, f):
+        self.slots.release()
+        self._task_done(group, time.perf_counter() - t_start)
+        if f is None:
+            return
+        try:
+            result = f.result()
+        except Exception as e:
+            if future is None:
+                log_traceback()
+            else:
+                future.set_exception(e)
+        else:
+            if future is not None:
+                future.set_result(result)
+
+
+class Batcher:
+    """
+    Collects items into batches by key
+
+    Batch is flushed, when it reaches max_size items, an urgent item is put or
+    in "window" seconds after its first item is put. Flush function is called with the key and the
+    list of items by either putting thread or the timer thread, so it should be
+    fast (e.g. submit a task to a pool).
+    """
+
+    def __init__(self, name, flush, window, max_size, timer):
+        self.name = name
+        self.flush = flush
+        self.window = window
+        self.max_size = max_size
+        self.timer = timer
+        self.batches = {}
+        self.lock = threading.Lock()
+
+    def put(self, key, item, urgent=False):
+        with self.lock:
+            batch = self.batches.pop(key, None)
+            if batch is None:
+                batch = []
+                if not urgent:
+                    self.timer.schedule(self.window, self._expire, key, batch)
+            batch.append(item)
+            if len(batch) < self.max_size and not urgent:
+                self.batches[key] = batch
+                return
+        self._flush(key, batch)
+
+    def _expire(self, key, batch):
+        with self.lock:
+            if self.batches.get(key) is not batch:
+                return
+            del self.batches[key]
+        self._flush(key, batch)
+
+    def _flush(self, key, batch):
+        try:
+            self.flush(key, batch)
+        except:
+            logger.error(f'CORE {self.name} unable to flush batch of '
+                         f'{len(batch)} item(s)')
+            log_traceback()
+
+    def pending(self):
+        """
+        Get number of items in not flushed batches
+        """
+        with self.lock:
+            return sum(len(batch) for batch in self.batches.values())
@@ -0,0 +1,177 @@
+__author__ = 'Altertech, http://www.altertech.com/'
+__copyright__ = 'Copyright (C) 2018-2020 Altertech Group'
+__license__ = 'Apache License 2.0'
+__version__ = '2.0.45'
+
+import base64
+import logging
+import threading
+import filetype
+
+from hashlib import sha256
+
+_media_locks = [threading.Lock() for _ in range(16)]
+
+
+class Event:
+    """
+    Event object
+
+    Created once per pushed event and shared by all its deliveries, so it
+    MUST NOT be modified. Derived fields (formatted_subject, media_encoded,
+    media_type, media_hash) are computed on the first access.
+
+    For compatibility, event can be used as read-only mapping of plugin send
+    kwargs (event['level'], event.get('msg'), **event)
+    """
+
+    __slots__ = ('event_id', 'addr', 'msg', 'subject', 'level', 'level_name',
+                 'location', 'tag', 'sender', 'media', 'media_fname',
+                 '_formatted_subject', '_media_encoded', '_media_type',
+                 '_media_hash', '_media_object_id')
+
+    # plugin send kwargs
+    fields = ('event_id', 'addr', 'msg', 'subject', 'formatted_subject',
+              'level', 'level_name', 'location', 'tag', 'sender', 'media',
+              'media_encoded', 'media_fname')
+
+    def __init__(self,
+                 event_id,
+                 addr,
+                 msg='',
+                 subject='',
+                 level=20,
+                 level_name=None,
+                 location=None,
+                 tag=None,
+                 sender=None,
+                 media=None,
+                 media_encoded=None,
+                 media_fname=None,
+                 formatted_subject=None):
+        self.event_id = event_id
+        self.addr = addr
+        self.msg = msg
+        self.subject = subject
+        self.level = level
+        self.level_name = level_name if level_name is not None else \
+                logging.getLevelName(level)
+        self.location = location
+        self.tag = tag
+        self.sender = sender
+        self.media = media
+        self.media_fname = media_fname
+        self._formatted_subject = formatted_subject
+        self._media_encoded = media_encoded
+        self._media_type = None
+        self._media_hash = None
+        self._media_object_id = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Create event from dict, as returned by to_dict
+        """
+        data = {k: v for k, v in data.items() if k in cls.fields}
+        if data.get('media') is None and data.get('media_encoded'):
+            data['media'] = base64.b64decode(data['media_encoded'])
+        return cls(**data)
+
+    def to_dict(self):
+        """
+        Get event as JSON-serializable dict (without binary media)
+        """
+        return {k: getattr(self, k) for k in self.fields if k != 'media'}
+
+    def kwargs(self, media_encoded=True):
+        """
+        Get plugin send kwargs
+
+        Args:
+            media_encoded: if False, media_encoded is set to None
+        """
+        result = {
+            k: getattr(self, k) for k in self.fields if k != 'media_encoded'
+        }
+        # encode media only on demand
+        result['media_encoded'] = self.media_encoded if media_encoded else None
+        return result
+
+    @property
+    def formatted_subject(self):
+        if self._formatted_subject is None:
+            if self.sender:
+                s = self.sender.split('@', 1)[0] if self.location else \
+                        self.sender
+            else:
+                s = ''
+            self._formatted_subject = '{} {}{}{}'.format(
+                self.level_name, s,
+                f'@{self.location}' if self.location else '',
+                f': {self.subject}' if self.subject else '')
+        return self._formatted_subject
+
+    @property
+    def media_encoded(self):
+        if self._media_encoded is None and self.media:
+            self._media_encoded = base64.b64encode(self.media).decode()
+        return self._media_encoded
+
+    @property
+    def media_type(self):
+        """
+        Media file type, as guessed by filetype module (None if unknown)
+        """
+        if self._media_type is None and self.media:
+            self._media_type = filetype.guess(self.media) or False
+        return self._media_type or None
+
+    @property
+    def media_hash(self):
+        """
+        SHA256 hex digest of media (None if event has no media)
+        """
+        if self._media_hash is None and self.media:
+            self._media_hash = sha256(self.media).hexdigest()
+        return self._media_hash
+
+    def media_object_id(self, put):
+        """
+        Get bucket object ID of event media
+
+        The object is created with put(event) on the first call, the next
+        calls get the same object ID
+
+        Returns:
+            bucket object ID or None if event has no media
+        """
+        if not self.media:
+            return None
+        if self._media_object_id is None:
+            with _media_locks[hash(self.event_id) % len(_media_locks)]:
+                if self._media_object_id is None:
+                    self._media_object_id = put(self)
+        return self._media_object_id
+
+    def size(self):
+        """
+        Event payload size
+        """
+        return sum(
+            len(v)
+            for v in (self.media, self._media_encoded, self.msg, self.subject)
+            if v)
+
+    def keys(self):
+        return self.fields
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.fields else default
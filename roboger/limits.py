@@ -0,0 +1,128 @@
+__author__ = 'Altertech, http://www.altertech.com/'
+__copyright__ = 'Copyright (C) 2018-2020 Altertech Group'
+__license__ = 'Apache License 2.0'
+__version__ = '2.0.45'
+
+import os
+import fcntl
+import mmap
+import struct
+import threading
+
+from .core import logger
+
+# addr id, window, count, size, previous window count, previous window size
+_slot = struct.Struct('<qqqqqq')
+
+_group_slots = 8
+
+
+class MmapLimiter:
+    """
+    Address limit counters in shared memory-mapped file
+
+    For single-node deployments: all workers of the node map the same file.
+    Address counters are kept in fixed slots, an address is hashed into a
+    group of slots. Groups are locked with fcntl record locks (between
+    processes) and thread locks (inside the process), so check and increment
+    are atomic.
+
+    Slots of addresses, which had no messages during the previous window, are
+    reused. If all group slots are busy, the limits are not checked.
+    """
+
+    def __init__(self, path, slots):
+        self.groups = max(slots // _group_slots, 1)
+        self.size = self.groups * _group_slots * _slot.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self.fd).st_size != self.size:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, self.size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.mm = mmap.mmap(self.fd, self.size)
+        self.locks = [threading.Lock() for _ in range(min(self.groups, 256))]
+
+    def acquire(self, a, window, weight, count, size, lim_c, lim_s, k):
+        """
+        Check limits and increment counters
+
+        Args:
+            a: address id
+            window: current window number
+            weight: previous window weight (sliding window)
+            count: messages count
+            size: messages size
+            lim_c: count limit
+            lim_s: size limit
+            k: available share of limits
+        Returns:
+            0 if passed or the overlimit code: 1 - count, 2 - count
+            (reserved), 3 - size, 4 - size (reserved)
+        """
+        group = a % self.groups
+        start = group * _group_slots * _slot.size
+        length = _group_slots * _slot.size
+        with self.locks[group % len(self.locks)]:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, start)
+            try:
+                offset = self._find_slot(a, window, start)
+                if offset is None:
+                    logger.warning(f'CORE limits mmap group {group} is full, '
+                                   f'addr.id={a} is not checked')
+                    return 0
+                slot_a, slot_window, c, s, c_prev, s_prev = _slot.unpack_from(
+                    self.mm, offset)
+                if slot_a != a or slot_window < window - 1:
+                    c = s = c_prev = s_prev = 0
+                elif slot_window == window - 1:
+                    c_prev, s_prev = c, s
+                    c = s = 0
+                cur_c = c + weight * c_prev
+                cur_s = s + weight * s_prev
+                if cur_c + count > lim_c:
+                    code = 1
+                elif cur_c + count > lim_c * k:
+                    code = 2
+                elif cur_s + size > lim_s:
+                    code = 3
+                elif cur_s + size > lim_s * k:
+                    code = 4
+                else:
+                    code = 0
+                    c += count
+                    s += size
+                _slot.pack_into(self.mm, offset, a, window, c, s, c_prev,
+                                s_prev)
+                return code
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, start)
+
+    def _find_slot(self, a, window, start):
+        free = None
+        for i in range(_group_slots):
+            offset = start + i * _slot.size
+            slot_a, slot_window = struct.unpack_from('<qq', self.mm, offset)
+            if slot_a == a:
+                return offset
+            elif free is None and (slot_a == 0 or slot_window < window - 1):
+                free = offset
+        return free
+
+    def reset(self):
+        """
+        Reset all counters
+        """
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+            try:
+                self.mm[:] = bytes(self.size)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        finally:
+            for lock in self.locks:
+                lock.release()
@@ -7,11 +7,18 @@ from types import SimpleNamespace
 from pyfcm import FCMNotification
 from jsonschema import validate
 
-from roboger.core import logger, log_traceback, bucket_put
+from roboger.core import logger, log_traceback, bucket_put, endpoint_update
+from roboger.core import event_media_put
 from pyaltt2.config import config_value
 
+# media is put to the bucket as binary
+need_media_encoded = False
+
 _cfg = SimpleNamespace(api_key=None)
 
+# FCM errors, after which the token can not be used any more
+_invalid_token_errors = {'NotRegistered', 'InvalidRegistration'}
+
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
     'properties': {
@@ -42,34 +49,112 @@ def load(plugin_config, **kwargs):
     _cfg.push_service = FCMNotification(api_key=api_key)
 
 
-def send(config, event_id, addr_id, msg, subject, formatted_subject, sender,
-         location, media, media_fname, level, **kwargs):
-    if config.get('registration_id'):
-        data = {
-            'location': location,
-            'sender': sender if sender else 'roboger',
-            'level': level,
-            'subject': subject,
-            'id': event_id,
-            'msg': msg
-        }
-        if media:
+def _format_data(event_id, addr_id, msg, subject, sender, location, media,
+                 media_fname, level, event=None, **kwargs):
+    data = {
+        'location': location,
+        'sender': sender if sender else 'roboger',
+        'level': level,
+        'subject': subject,
+        'id': event_id,
+        'msg': msg
+    }
+    if media:
+        if event:
+            ft = event.media_type
+            object_id = event_media_put(event,
+                                        creator='plugin.android',
+                                        addr_id=addr_id)
+        else:
             ft = filetype.guess(media)
             object_id = bucket_put(content=media,
                                    creator='plugin.android',
                                    addr_id=addr_id,
+                                   mimetype=ft.mime if ft else None,
                                    public=True,
                                    fname=media_fname if media_fname else None)
-            data['media'] = {
-                'type': (ft.extension if ft else 'Unknown'),
-                'data': object_id
-            }
-        _cfg.push_service.single_device_data_message(
-            registration_id=config['registration_id'], data_message=data)
+        data['media'] = {
+            'type': (ft.extension if ft else 'Unknown'),
+            'data': object_id
+        }
+    return data
+
+
+def _process_results(event_id, tokens, response):
+    """
+    Process FCM results
+
+    Args:
+        tokens: dict registration id / list of (endpoint id, delivery index)
+        response: FCM response
+    Returns:
+        dict delivery index / exception for failed deliveries
+    """
+    failed = {}
+    for (token, deliveries), result in zip(tokens.items(),
+                                           response.get('results', [])):
+        error = result.get('error')
+        if error is None:
+            continue
+        elif error in _invalid_token_errors:
+            for endpoint_id, _ in deliveries:
+                logger.warning(f'{__name__} {event_id} FCM token of endpoint '
+                               f'{endpoint_id} is invalid ({error}), '
+                               'deactivating endpoint')
+                try:
+                    endpoint_update(endpoint_id, {'active': 0})
+                except:
+                    log_traceback()
+        else:
+            for _, i in deliveries:
+                failed[i] = RuntimeError(f'{__name__} FCM error {error}')
+    return failed
+
+
+def send(config, event_id, endpoint_id=None, **kwargs):
+    token = config.get('registration_id')
+    if token:
+        response = _cfg.push_service.single_device_data_message(
+            registration_id=token,
+            data_message=_format_data(event_id, **kwargs))
+        for error in _process_results(event_id,
+                                      {token: [(endpoint_id, 0)]},
+                                      response).values():
+            raise error
     else:
         logger.info(f'{__name__} {event_id} ignored, device not active')
 
 
+def send_batch(deliveries, **kwargs):
+    # event is sent to all its devices with a single multicast message
+    results = [None] * len(deliveries)
+    events = {}
+    for i, d in enumerate(deliveries):
+        token = d['config'].get('registration_id')
+        if token:
+            events.setdefault(d['event_id'], {}).setdefault(token, []).append(
+                (d.get('endpoint_id'), i))
+        else:
+            logger.info(f'{__name__} {d["event_id"]} ignored, '
+                        'device not active')
+    for event_id, tokens in events.items():
+        try:
+            first = next(iter(tokens.values()))[0][1]
+            logger.debug(f'{__name__} {event_id} sending FCM message to '
+                         f'{len(tokens)} device(s)')
+            response = _cfg.push_service.multiple_devices_data_message(
+                registration_ids=list(tokens),
+                data_message=_format_data(**deliveries[first]))
+            for i, error in _process_results(event_id, tokens,
+                                             response).items():
+                results[i] = error
+        except Exception as e:
+            for token_deliveries in tokens.values():
+                for _, i in token_deliveries:
+                    results[i] = e
+    return results
+
+
 def validate_config(config, **kwargs):
     validate(config, schema=PROPERTY_MAP_SCHEMA)
 
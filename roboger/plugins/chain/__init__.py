@@ -1,11 +1,13 @@
 __version__ = '1.0.0'
 __description__ = 'forwards event to another Roboger server'
 
-import requests
-
 from jsonschema import validate
 
-from roboger.core import logger, log_traceback, product, get_timeout
+from roboger.core import logger, HTTPStatusError, is_http_async
+from roboger.core import http_sender, http_post, http_post_async
+
+# media is sent base64-encoded
+need_media_encoded = True
 
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
@@ -21,10 +23,13 @@ PROPERTY_MAP_SCHEMA = {
     'additionalProperties': False
 }
 
+# target servers, which have no batch API
+_servers_without_batch = set()
+
 _copy_fields = ['msg', 'subject', 'level', 'location', 'tag', 'sender']
 
 
-def send(config, **kwargs):
+def _prepare(config, **kwargs):
     url = config['url']
     addr = config['addr']
     if url.endswith('/'):
@@ -34,12 +39,99 @@ def send(config, **kwargs):
     data['addr'] = addr
     logger.debug(f'{__name__} {kwargs["event_id"]} '
                  f'sending Roboger chain event to {url} {addr}')
-    r = requests.post(f'{url}/push',
-                      headers={'User-Agent': product.user_agent},
-                      json=data,
-                      timeout=get_timeout())
-    if not r.ok:
-        raise RuntimeError(f'{__name__} server {url} status {r.status_code}')
+    return url, data
+
+
+def _prepare_batch(deliveries):
+    # deliveries are grouped by the target server
+    batches = {}
+    for i, kwargs in enumerate(deliveries):
+        url, data = _prepare(**kwargs)
+        batches.setdefault(url, []).append((i, data))
+    return batches
+
+
+def _batch_results(url, batch, response, results):
+    if len(response) != len(batch):
+        raise RuntimeError(f'{__name__} server {url} invalid batch reply')
+    for (i, _), r in zip(batch, response):
+        if r.get('code') != 202:
+            results[i] = HTTPStatusError(f'{__name__} server {url} event '
+                                         f'status {r.get("code")}',
+                                         status=r.get('code'))
+
+
+def _prepare_push(config, **kwargs):
+    url, data = _prepare(config, **kwargs)
+    return f'{url}/push', {'json': data}
+
+
+send = http_sender(_prepare_push)
+
+
+def _no_batch_api(url, e):
+    """
+    Check if the batch request failed as the target server has no batch API
+    (servers before 2.0.45), such servers are remembered
+    """
+    if isinstance(e, HTTPStatusError) and e.status in (404, 405):
+        logger.info(f'{__name__} server {url} has no batch API, '
+                    'sending events one by one')
+        _servers_without_batch.add(url)
+        return True
+    return False
+
+
+def _send_batch(deliveries, **kwargs):
+    results = [None] * len(deliveries)
+    for url, batch in _prepare_batch(deliveries).items():
+        if url not in _servers_without_batch:
+            try:
+                _batch_results(
+                    url, batch,
+                    http_post(f'{url}/push/batch',
+                              reply=True,
+                              json=[data for _, data in batch]), results)
+                continue
+            except Exception as e:
+                if not _no_batch_api(url, e):
+                    for i, _ in batch:
+                        results[i] = e
+                    continue
+        for i, data in batch:
+            try:
+                http_post(f'{url}/push', json=data)
+            except Exception as e:
+                results[i] = e
+    return results
+
+
+async def _send_batch_async(deliveries, **kwargs):
+    results = [None] * len(deliveries)
+    for url, batch in _prepare_batch(deliveries).items():
+        if url not in _servers_without_batch:
+            try:
+                _batch_results(
+                    url, batch, await
+                    http_post_async(f'{url}/push/batch',
+                                    reply=True,
+                                    json=[data for _, data in batch]),
+                    results)
+                continue
+            except Exception as e:
+                if not _no_batch_api(url, e):
+                    for i, _ in batch:
+                        results[i] = e
+                    continue
+        for i, data in batch:
+            try:
+                await http_post_async(f'{url}/push', json=data)
+            except Exception as e:
+                results[i] = e
+    return results
+
+
+send_batch = _send_batch_async if is_http_async() else _send_batch
 
 
 def validate_config(config, **kwargs):
@@ -4,6 +4,8 @@ __description__ = 'sends event by email'
 import smtplib
 import filetype
 import platform
+import threading
+import time
 
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
@@ -13,12 +15,25 @@ from types import SimpleNamespace
 from pyaltt2.network import parse_host_port
 from pyaltt2.mail import SMTP
 
-from roboger.core import logger, log_traceback
+from roboger.core import logger, log_traceback, get_timeout
 from pyaltt2.config import config_value
 
 from jsonschema import validate
 
-_d = SimpleNamespace(smtp=None, default_location=platform.node())
+# media is sent as binary attachment
+need_media_encoded = False
+
+_d = SimpleNamespace(smtp=None,
+                     pool=None,
+                     default_location=platform.node(),
+                     multi_rcpt=False)
+
+default_pool_size = 2
+
+default_idle_timeout = 60
+
+# idle sessions are checked with NOOP before reuse
+_session_check_after = 5
 
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
@@ -56,11 +71,22 @@ PLUGIN_PROPERTY_MAP_SCHEMA = {
                 'password': {
                     'type': 'string',
                 },
+                'pool-size': {
+                    'type': 'integer',
+                    'minimum': 1
+                },
+                'idle-timeout': {
+                    'type': 'number',
+                    'minimum': 0
+                },
             },
             'required': ['host']
         },
         'default-location': {
             'type': 'string',
+        },
+        'multi-rcpt': {
+            'type': 'boolean',
         }
     },
     'additionalProperties': False,
@@ -70,51 +96,267 @@ PLUGIN_PROPERTY_MAP_SCHEMA = {
 def load(plugin_config, **kwargs):
     if 'smtp' in plugin_config:
         _d.default_location = plugin_config.get('default-location')
-        smtp_config = plugin_config['smtp']
+        _d.multi_rcpt = plugin_config.get('multi-rcpt', False)
+        smtp_config = plugin_config['smtp'].copy()
         config_value(config=smtp_config, config_path='/password', default=None, in_place=True)
+        pool_size = smtp_config.pop('pool-size', default_pool_size)
+        idle_timeout = smtp_config.pop('idle-timeout', default_idle_timeout)
         _d.smtp = SMTP(**smtp_config)
+        _d.pool = _SessionPool(_d.smtp, pool_size, idle_timeout)
         logger.debug(
             f'{__name__} loaded, SMTP server: {_d.smtp.host}:{_d.smtp.port}, '
             f'ssl: {_d.smtp.ssl}, tls: {_d.smtp.tls}, '
-            f'auth: {_d.smtp.login is not None}')
+            f'auth: {_d.smtp.login is not None}, pool size: {pool_size}')
     else:
         logger.error(f'{__name__} not active, no SMTP server provided')
 
 
-def send(config, event_id, msg, formatted_subject, sender, location, media,
-         media_fname, **kwargs):
-    if _d.smtp:
+class _SessionPool:
+    """
+    Pool of connected (and authenticated) SMTP sessions
+
+    Sessions are reused until closed by the server or idle for more than
+    idle_timeout seconds. Sessions, which were idle for a while, are checked
+    with NOOP before reuse. Sessions with socket errors are closed and
+    discarded.
+    """
+
+    def __init__(self, smtp, size, idle_timeout):
+        self.smtp = smtp
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        sm = self.smtp.sendfunc(self.smtp.host,
+                                self.smtp.port,
+                                timeout=get_timeout())
+        try:
+            if self.smtp.debug:
+                sm.set_debuglevel(9)
+            sm.ehlo()
+            if self.smtp.tls:
+                sm.starttls()
+                sm.ehlo()
+            if self.smtp.login is not None:
+                sm.login(self.smtp.login, self.smtp.password)
+        except:
+            self._close(sm)
+            raise
+        logger.debug(f'{__name__} connected to SMTP server '
+                     f'{self.smtp.host}:{self.smtp.port}')
+        return sm
+
+    @staticmethod
+    def _close(sm):
+        try:
+            sm.quit()
+        except:
+            try:
+                sm.close()
+            except:
+                pass
+
+    def _get_idle(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                sm, last_used = self.idle.pop()
+            idle = time.monotonic() - last_used
+            if idle > self.idle_timeout:
+                self._close(sm)
+                continue
+            if idle > _session_check_after:
+                try:
+                    if sm.noop()[0] != 250:
+                        raise smtplib.SMTPException
+                except:
+                    self._close(sm)
+                    continue
+            return sm
+
+    def sendmail(self, messages):
+        """
+        Send messages in a single session
+
+        Args:
+            messages: list of (sender, recipients, body)
+        Returns:
+            list of results: None if sent, exception object if failed
+            (SMTPRecipientsRefused if some of recipients are refused)
+        """
+        results = []
+        with self.slots:
+            sm = self._get_idle()
+            reused = sm is not None
+            connect_error = None
+            for sender, rcpt, body in messages:
+                if connect_error is not None:
+                    results.append(connect_error)
+                    continue
+                try:
+                    if sm is None:
+                        sm = self._connect()
+                        reused = False
+                    try:
+                        refused = sm.sendmail(sender, rcpt, body)
+                    except smtplib.SMTPServerDisconnected:
+                        if not reused:
+                            raise
+                        # reused session has been closed by the server
+                        self._close(sm)
+                        sm = None
+                        sm = self._connect()
+                        reused = False
+                        refused = sm.sendmail(sender, rcpt, body)
+                    # some of recipients are refused
+                    results.append(
+                        smtplib.SMTPRecipientsRefused(refused
+                                                     ) if refused else None)
+                except (smtplib.SMTPRecipientsRefused,
+                        smtplib.SMTPResponseException) as e:
+                    if sm is None:
+                        connect_error = e
+                    # otherwise the message is rejected, the session is still
+                    # usable
+                    results.append(e)
+                except Exception as e:
+                    # socket errors, timeouts and disconnects
+                    if sm is None:
+                        connect_error = e
+                    else:
+                        self._close(sm)
+                        sm = None
+                    results.append(e)
+            if sm is not None:
+                with self.lock:
+                    self.idle.append((sm, time.monotonic()))
+        return results
+
+    def cleanup(self):
+        """
+        Close expired idle sessions
+        """
+        with self.lock:
+            now = time.monotonic()
+            expired = [
+                sm for sm, last_used in self.idle
+                if now - last_used > self.idle_timeout
+            ]
+            self.idle = [(sm, last_used)
+                         for sm, last_used in self.idle
+                         if now - last_used <= self.idle_timeout]
+        for sm in expired:
+            self._close(sm)
+
+
+def _build_message(msg, formatted_subject, sender, location, media,
+                   media_fname, event=None, **kwargs):
+    """
+    Build message without recipient header
+
+    Returns:
+        tuple (sender, message string)
+    """
+    if not sender:
+        sender = 'roboger'
+    if '@' not in sender:
+        sender += '@{}'.format(location if location else _d.default_location)
+    m = MIMEMultipart() if media else MIMEText(msg if msg is not None else '')
+    m['Subject'] = formatted_subject
+    m['From'] = sender
+    if media:
+        m.attach(MIMEText(msg if msg is not None else ''))
+        if not media_fname:
+            ft = event.media_type if event else filetype.guess(media)
+            media_fname = 'attachment.txt' if ft is None else \
+                    f'attachment.{ft.extension}'
+        a = MIMEApplication(media, Name=media_fname)
+        a['Content-Disposition'] = (f'attachment; '
+                                    f'filename="{media_fname}"')
+        m.attach(a)
+    return sender, m.as_string()
+
+
+def _with_rcpt(body, rcpt):
+    return f'To: {rcpt}\n{body}'
+
+
+def send(config, event_id, **kwargs):
+    if _d.pool:
         rcpt = config.get('rcpt')
         if rcpt:
             logger.debug(f'{__name__} {event_id} sending message to {rcpt}')
-            if not sender:
-                sender = 'roboger'
-            if '@' not in sender:
-                sender += '@{}'.format(
-                    location if location else _d.default_location)
-            m = MIMEMultipart() if media else MIMEText(
-                msg if msg is not None else '')
-            m['Subject'] = formatted_subject
-            m['From'] = sender
-            m['To'] = rcpt
-            if media:
-                m.attach(MIMEText(msg if msg is not None else ''))
-                if not media_fname:
-                    ft = filetype.guess(media)
-                    media_fname = 'attachment.txt' if ft is None else \
-                            f'attachment.{ft.extension}'
-                a = MIMEApplication(media, Name=media_fname)
-                a['Content-Disposition'] = (f'attachment; '
-                                            f'filename="{media_fname}"')
-                m.attach(a)
-            _d.smtp.send(sender, rcpt, m.as_string())
+            sender, body = _build_message(**kwargs)
+            error = _d.pool.sendmail([(sender, [rcpt],
+                                       _with_rcpt(body, rcpt))])[0]
+            if error is not None:
+                raise error
         else:
             logger.debug(f'{__name__} {event_id} failed to'
-                         f' send message from {sender} to {rcpt}')
+                         f' send message, recipient is not set')
     else:
         logger.error(f'{__name__} {event_id} ignored, not active')
 
 
+def send_batch(deliveries, **kwargs):
+    # messages are built once per event and sent in a single SMTP session
+    if not _d.pool:
+        logger.error(f'{__name__} {len(deliveries)} deliveries ignored, '
+                     'not active')
+        return None
+    results = [None] * len(deliveries)
+    events = {}
+    for i, d in enumerate(deliveries):
+        rcpt = d['config'].get('rcpt')
+        if rcpt:
+            events.setdefault(d['event_id'], {}).setdefault(rcpt, []).append(i)
+        else:
+            logger.debug(f'{__name__} {d["event_id"]} failed to'
+                         f' send message, recipient is not set')
+    messages = []
+    for event_id, recipients in events.items():
+        try:
+            sender, body = _build_message(
+                **deliveries[next(iter(recipients.values()))[0]])
+        except Exception as e:
+            for idx in recipients.values():
+                for i in idx:
+                    results[i] = e
+            continue
+        if _d.multi_rcpt and len(recipients) > 1:
+            logger.debug(f'{__name__} {event_id} sending message to '
+                         f'{len(recipients)} recipients')
+            messages.append((recipients, (sender, list(recipients),
+                                          _with_rcpt(
+                                              body,
+                                              'undisclosed-recipients:;'))))
+        else:
+            for rcpt, idx in recipients.items():
+                logger.debug(f'{__name__} {event_id} sending message to '
+                             f'{rcpt}')
+                messages.append(({
+                    rcpt: idx
+                }, (sender, [rcpt], _with_rcpt(body, rcpt))))
+    if messages:
+        for (recipients, _), result in zip(
+                messages, _d.pool.sendmail([m for _, m in messages])):
+            for rcpt, idx in recipients.items():
+                if isinstance(result, smtplib.SMTPRecipientsRefused) and \
+                        rcpt not in result.recipients:
+                    continue
+                for i in idx:
+                    results[i] = result
+    return results
+
+
+def cleanup(**kwargs):
+    if _d.pool:
+        _d.pool.cleanup()
+
+
 def validate_config(config, **kwargs):
     validate(config, schema=PROPERTY_MAP_SCHEMA)
 
@@ -8,6 +8,9 @@ from jsonschema import validate
 
 from roboger.core import logger, log_traceback, product, get_timeout
 
+# media is passed base64-encoded
+need_media_encoded = True
+
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
     'properties': {
@@ -1,11 +1,12 @@
 __version__ = '1.0.0'
 __description__ = 'sends event to Slack'
 
-import requests
-
 from jsonschema import validate
 
-from roboger.core import logger, log_traceback, product, get_timeout
+from roboger.core import logger, http_sender
+
+# media is not sent
+need_media_encoded = False
 
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
@@ -30,8 +31,8 @@ slack_color = {
 }
 
 
-def send(config, event_id, level, formatted_subject, subject, msg, sender,
-         **kwargs):
+def _prepare(config, event_id, level, formatted_subject, subject, msg, sender,
+             **kwargs):
     url = config['url']
     logger.debug(f'{__name__} {event_id} sending Slack webhook to {url}')
     if config.get('rich'):
@@ -52,12 +53,10 @@ def send(config, event_id, level, formatted_subject, subject, msg, sender,
         data = {'text': f'{formatted_subject}\n{msg}'}
     if sender:
         data['username'] = sender
-    r = requests.post(url,
-                      headers={'User-Agent': product.user_agent},
-                      json=data,
-                      timeout=get_timeout())
-    if not r.ok:
-        raise RuntimeError(f'{__name__} server {url} status {r.status_code}')
+    return url, {'json': data}
+
+
+send = http_sender(_prepare)
 
 
 def validate_config(config, **kwargs):
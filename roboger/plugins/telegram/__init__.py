@@ -2,6 +2,8 @@ __version__ = '1.0.0'
 __description__ = 'sends event via Telegram bot'
 
 import tebot.bot
+import filetype
+import threading
 
 from roboger.core import logger, log_traceback, config as core_config
 from roboger.core import get_app, get_timeout, emoji_code
@@ -10,6 +12,8 @@ from pyaltt2.config import config_value
 
 from flask import request
 from types import SimpleNamespace
+from collections import OrderedDict
+from hashlib import sha256
 
 from jsonschema import validate
 
@@ -19,7 +23,21 @@ tebot.bot.logger = logging.getLogger('gunicorn.error')
 
 bot = tebot.bot.TeBot()
 
-_d = SimpleNamespace(ce=None)
+# media is uploaded as binary file
+need_media_encoded = False
+
+_d = SimpleNamespace(ce=None,
+                     file_ids=OrderedDict(),
+                     file_ids_size=1000,
+                     file_ids_lock=threading.Lock(),
+                     uploads={})
+
+# media type: API method, media field
+_media_methods = {
+    'image': ('sendPhoto', 'photo'),
+    'video': ('sendVideo', 'video'),
+    'audio': ('sendAudio', 'audio')
+}
 
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
@@ -36,6 +54,10 @@ PLUGIN_PROPERTY_MAP_SCHEMA = {
     'properties': {
         'token': {
             'type': 'string',
+        },
+        'file-id-cache': {
+            'type': 'integer',
+            'minimum': 0
         }
     },
     'additionalProperties': False,
@@ -47,6 +69,7 @@ def load(plugin_config, **kwargs):
     token = config_value(config=plugin_config, config_path='/token')
     bot.set_token(token)
     _d.ce = Rioja(token)
+    _d.file_ids_size = plugin_config.get('file-id-cache', 1000)
     bot.timeout = get_timeout()
     mykey = gen_random_str()
     get_app().add_url_rule(f'/plugin/telegram/{mykey}',
@@ -88,10 +111,99 @@ def webhook():
     return {'ok': True}
 
 
-def send(config, event_id, msg, sender, formatted_subject, media, level,
+def prepare(config, **kwargs):
+    if 'chat_id' in config:
+        return _d.ce.decrypt(config['chat_id'])
+
+
+def _file_id_put(key, file_id):
+    with _d.file_ids_lock:
+        _d.file_ids[key] = file_id
+        _d.file_ids.move_to_end(key)
+        while len(_d.file_ids) > _d.file_ids_size:
+            _d.file_ids.popitem(last=False)
+
+
+def _file_id_drop(key, file_id):
+    with _d.file_ids_lock:
+        if _d.file_ids.get(key) == file_id:
+            del _d.file_ids[key]
+
+
+def _send_media(chat_id, media, caption, event=None, **kwargs):
+    """
+    Send media
+
+    Media is uploaded once, Telegram file_id of the uploaded media is cached
+    (by content hash) and used for the next sends of the same media. If the
+    media is being uploaded by another delivery, the send waits for the upload
+    to finish and uses its file_id.
+    """
+    ft = event.media_type if event else filetype.guess(media)
+    method, field = _media_methods.get(
+        ft.mime.split('/', 1)[0] if ft else None, ('sendDocument', 'document'))
+    payload = bot._format_payload(
+        {
+            'chat_id': chat_id,
+            'caption': caption,
+            'parse_mode': 'HTML'
+        }, **kwargs)
+    if not _d.file_ids_size:
+        return bot.call(method, payload, {field: media})
+    key = (field, event.media_hash if event else sha256(media).hexdigest())
+    while True:
+        with _d.file_ids_lock:
+            file_id = _d.file_ids.get(key)
+            if file_id is not None:
+                _d.file_ids.move_to_end(key)
+                upload = None
+            else:
+                upload = _d.uploads.get(key)
+                if upload is None:
+                    # this delivery uploads the media
+                    upload = _d.uploads[key] = threading.Event()
+                    break
+        if file_id is not None:
+            result = bot.call(method, dict(payload, **{field: file_id}),
+                              retry=False)
+            if result:
+                return result
+            # file_id can be expired or revoked, upload the media again
+            _file_id_drop(key, file_id)
+        else:
+            upload.wait()
+    try:
+        result = bot.call(method, payload, {field: media})
+        if result:
+            try:
+                sent = result['result'][field]
+                # photos are returned as a list of sizes, the last is the
+                # original
+                file_id = (sent[-1]
+                           if isinstance(sent, list) else sent)['file_id']
+            except (KeyError, IndexError, TypeError):
+                pass
+            else:
+                _file_id_put(key, file_id)
+        return result
+    finally:
+        with _d.file_ids_lock:
+            del _d.uploads[key]
+        upload.set()
+
+
+def send(config,
+         event_id,
+         msg,
+         sender,
+         formatted_subject,
+         media,
+         level,
+         prepared=None,
          **kwargs):
     if 'chat_id' in config:
-        chat_id = _d.ce.decrypt(config['chat_id'])
+        chat_id = prepared if prepared is not None else _d.ce.decrypt(
+            config['chat_id'])
         if not sender: sender = ''
         text = (f'<pre>{sender}</pre>\n'
                 f'<b>{emoji_code.get(level, "")}{formatted_subject}</b>\n{msg}')
@@ -101,10 +213,11 @@ def send(config, event_id, msg, sender, formatted_subject, media, level,
                             disable_web_page_preview=True,
                             disable_notification=quiet):
             if media:
-                if not bot.send(text=f'<pre>{sender}</pre>',
-                                chat_id=chat_id,
-                                media=media,
-                                disable_notification=quiet):
+                if not _send_media(chat_id,
+                                   media,
+                                   caption=f'<pre>{sender}</pre>',
+                                   event=kwargs.get('event'),
+                                   disable_notification=quiet):
                     logger.warning(
                         f'{__name__} {event_id} failed to send media')
         else:
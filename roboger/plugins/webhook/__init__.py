@@ -1,7 +1,6 @@
 __version__ = '1.0.0'
 __description__ = 'sends event via custom webhook'
 
-import requests
 import re
 
 from jsonschema import validate
@@ -10,7 +9,10 @@ try:
 except:
     import json
 
-from roboger.core import logger, log_traceback, product, get_timeout
+from roboger.core import logger, http_sender
+
+# media is sent base64-encoded
+need_media_encoded = True
 
 PROPERTY_MAP_SCHEMA = {
     'type': 'object',
@@ -31,43 +33,65 @@ _template_fields = [
     'level_name', 'location', 'tag', 'sender', 'media'
 ]
 
+_template_field_re = re.compile(r'\$(' + '|'.join(
+    sorted(_template_fields, key=len, reverse=True)) + r')(?!_)')
+
+
+class _Template:
+    """
+    Compiled template: literal segments and field slots
+    """
+
+    __slots__ = ('segments', 'slots')
+
+    def __init__(self, template):
+        self.segments = _template_field_re.split(
+            template.replace('\n', '').replace('\r', ''))
+        # split puts field names to odd positions
+        self.slots = [(i, self.segments[i])
+                      for i in range(1, len(self.segments), 2)]
+
+    def render(self, **kwargs):
+        segments = self.segments.copy()
+        for i, field in self.slots:
+            segments[i] = json.dumps(
+                kwargs.get('media_encoded' if field == 'media' else field))
+        return ''.join(segments)
+
 
-def send(config, **kwargs):
+def prepare(config, **kwargs):
     if 'template' in config:
-        data = config['template'].replace('\n', '').replace('\r', '')
-        for p in _template_fields:
-            v = kwargs.get('media_encoded' if p == 'media' else p)
-            if p == 'msg' and v:
-                v = v.replace('\r', '\\\\r').replace('\n', '\\\\n')
-            if p != 'level':
-                v = 'null' if v is None else f'"{v}"'
-            data = re.sub(fr'\${p}([^_])', fr'{v}\1', data)
+        return _Template(config['template'])
+
+
+def _build_request(config, prepared=None, **kwargs):
+    if 'template' in config:
+        template = prepared if prepared is not None else _Template(
+            config['template'])
+        data = template.render(**kwargs)
     else:
         data = "null"
     url = config['url']
     logger.debug(
         f'{__name__} {kwargs["event_id"]} sending JSON POST to {url} {data}')
-    r = requests.post(url,
-                      headers={
-                          'Content-Type': 'application/json',
-                          'Content-Length': str(len(data)),
-                          'User-Agent': product.user_agent
-                      },
-                      data=data,
-                      timeout=get_timeout())
-    if not r.ok:
-        raise RuntimeError(f'{__name__} server {url} status {r.status_code}')
+    data = data.encode()
+    return url, {
+        'data': data,
+        'headers': {
+            'Content-Type': 'application/json',
+            'Content-Length': str(len(data))
+        }
+    }
+
+
+send = http_sender(_build_request)
 
 
 def validate_config(config, **kwargs):
     validate(config, schema=PROPERTY_MAP_SCHEMA)
     tpl = config.get('template')
     if tpl is not None:
-        tpl = tpl.replace('\n', '').replace('\r', '')
-        for p in _template_fields:
-            val = 0 if p == 'level' else '""'
-            tpl = re.sub(fr'\${p}([^_])', fr'{val}\1', tpl)
-        json.loads(tpl)
+        json.loads(_Template(tpl).render(level=0))
 
 
 def validate_plugin_config(plugin_config, **kwargs):
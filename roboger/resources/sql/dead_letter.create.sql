@@ -0,0 +1,5 @@
+INSERT INTO dead_letter (addr_id, endpoint_id, plugin_name, config, event,
+    attempts, error, d)
+SELECT :addr_id, id, :plugin_name, :config, :event, :attempts, :error, :d
+FROM endpoint
+WHERE id=:endpoint_id
@@ -0,0 +1,3 @@
+DELETE
+FROM dead_letter
+WHERE id=:id
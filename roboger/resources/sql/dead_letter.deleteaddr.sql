@@ -0,0 +1,3 @@
+DELETE
+FROM dead_letter
+WHERE addr_id IN (SELECT id FROM addr WHERE id=:id or a=:a)
@@ -0,0 +1 @@
+DELETE FROM dead_letter
@@ -0,0 +1,3 @@
+DELETE
+FROM dead_letter
+WHERE endpoint_id=:id
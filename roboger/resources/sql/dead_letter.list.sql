@@ -0,0 +1,3 @@
+SELECT id, addr_id, endpoint_id, plugin_name, config, event
+FROM dead_letter
+ORDER BY id
@@ -1,4 +1,4 @@
-SELECT plugin_name, config, addr.id as addr_id
+SELECT endpoint.id AS endpoint_id, plugin_name, config, addr.id as addr_id
 FROM subscription JOIN endpoint ON
     endpoint.id = subscription.endpoint_id JOIN addr ON
     endpoint.addr_id = addr.id WHERE
@@ -0,0 +1,16 @@
+SELECT endpoint.id AS endpoint_id,
+       subscription.id AS subscription_id,
+       plugin_name,
+       config,
+       location,
+       tag,
+       sender,
+       level,
+       level_match
+FROM subscription JOIN endpoint ON
+    endpoint.id = subscription.endpoint_id JOIN addr ON
+    endpoint.addr_id = addr.id WHERE
+    addr.id=:addr_id
+    AND addr.active=1
+    AND subscription.active = 1
+    AND endpoint.active = 1
@@ -0,0 +1,257 @@
+__author__ = 'Altertech, http://www.altertech.com/'
+__copyright__ = 'Copyright (C) 2018-2020 Altertech Group'
+__license__ = 'Apache License 2.0'
+__version__ = '2.0.45'
+
+import os
+import fcntl
+import threading
+import time
+
+import pyaltt2.json as json
+
+from pathlib import Path
+
+from .core import logger, log_traceback
+
+
+class Spool:
+    """
+    Durable append-only event spool
+
+    Each worker process locks its own spool slot (sub-directory), so several
+    workers can share one spool directory. Unacknowledged events of free slots
+    (e.g. of stopped workers) are adopted by the worker, which opens the
+    spool. Slot files are segments, event and
+    acknowledgement records are appended to the segment, which holds the
+    event. Segment is deleted after rotation, as soon as all its events are
+    acknowledged.
+
+    Writes are synced to disk with group commit: the committer thread waits
+    commit_delay seconds to collect more records and then calls fsync once
+    for all of them.
+    """
+
+    def __init__(self, path, segment_size, commit_delay):
+        self.path = Path(path)
+        self.segment_size = segment_size
+        self.commit_delay = commit_delay
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        # segment number: file object
+        self.segments = {}
+        # segment number: unacknowledged events
+        self.pending = {}
+        # event id: segment number
+        self.events = {}
+        self.dirty = set()
+        self.current = None
+        self.seq = 0
+        self.synced = 0
+        self.error = None
+        self.slot = None
+        self._lock_fh = None
+
+    def open(self):
+        """
+        Lock free spool slot and adopt events of other free slots
+
+        Returns:
+            list of unacknowledged events (event, targets) to replay
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        n = 0
+        while True:
+            slot = self.path / str(n)
+            slot.mkdir(exist_ok=True)
+            fh = open(slot / 'lock', 'w')
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                fh.close()
+                n += 1
+        self.slot = slot
+        self._lock_fh = fh
+        logger.debug(f'CORE spool slot {self.slot} locked')
+        result = []
+        last = -1
+        for f in sorted(self.slot.glob('*.spool')):
+            seg = int(f.stem)
+            last = max(last, seg)
+            events = self._read_segment(f)
+            if events:
+                self.segments[seg] = open(f, 'a')
+                # terminate the last record in case it has been torn
+                self.segments[seg].write('\n')
+                self.pending[seg] = len(events)
+                for event_id, (event, targets) in events.items():
+                    self.events[event_id] = seg
+                    result.append((event, targets))
+            else:
+                f.unlink()
+        self._new_segment(last + 1)
+        result += self._adopt()
+        threading.Thread(target=self._committer,
+                         name='roboger_spool_committer',
+                         daemon=True).start()
+        return result
+
+    def _adopt(self):
+        """
+        Move unacknowledged events of free slots to the current segment
+
+        Returns:
+            list of adopted events (event, targets)
+        """
+        result = []
+        for slot in sorted(self.path.iterdir()):
+            if slot == self.slot or not slot.name.isdigit() or \
+                    not any(slot.glob('*.spool')):
+                continue
+            with open(slot / 'lock', 'w') as lock_fh:
+                try:
+                    fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # the slot is locked by a running worker
+                    continue
+                segments = sorted(slot.glob('*.spool'))
+                events = {}
+                for f in segments:
+                    events.update(self._read_segment(f))
+                if events:
+                    logger.warning(f'CORE spool adopting {len(events)} '
+                                   f'event(s) of slot {slot}')
+                    seg = self.current
+                    fh = self.segments[seg]
+                    for event_id, (event, targets) in events.items():
+                        fh.write(
+                            json.dumps({
+                                'e': event_id,
+                                'd': event,
+                                't': targets
+                            }) + '\n')
+                        self.pending[seg] += 1
+                        self.events[event_id] = seg
+                        result.append((event, targets))
+                    fh.flush()
+                    # the events must be synced before the slot segments are
+                    # deleted
+                    os.fsync(fh.fileno())
+                for f in segments:
+                    f.unlink()
+        return result
+
+    def _read_segment(self, f):
+        events = {}
+        with open(f) as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn write
+                    logger.warning(f'CORE spool {f} has broken record')
+                    continue
+                if 'a' in record:
+                    events.pop(record['a'], None)
+                else:
+                    events[record['e']] = (record['d'], record['t'])
+        return events
+
+    def _new_segment(self, seg):
+        self.current = seg
+        self.segments[seg] = open(self.slot / f'{seg:016d}.spool', 'a')
+        self.pending[seg] = 0
+
+    def put(self, event_id, event, targets):
+        """
+        Write event to spool, returns when the record is synced to disk
+
+        Args:
+            event_id: event id
+            event: event data (JSON-serializable)
+            targets: event targets (JSON-serializable)
+        """
+        record = json.dumps({'e': event_id, 'd': event, 't': targets}) + '\n'
+        with self.lock:
+            seg = self.current
+            fh = self.segments[seg]
+            fh.write(record)
+            self.pending[seg] += 1
+            self.events[event_id] = seg
+            self.dirty.add(seg)
+            self.seq += 1
+            seq = self.seq
+            self.cond.notify_all()
+            if fh.tell() >= self.segment_size:
+                # the old segment is synced by committer as it's dirty
+                self._new_segment(seg + 1)
+            while self.synced < seq:
+                self.cond.wait()
+            if self.error:
+                # the event is not accepted, so it must not be replayed
+                self._ack(event_id)
+                raise RuntimeError(f'spool write error: {self.error}')
+
+    def ack(self, event_id):
+        """
+        Acknowledge event delivery
+        """
+        with self.lock:
+            self._ack(event_id)
+
+    def _ack(self, event_id):
+        seg = self.events.pop(event_id, None)
+        if seg is None:
+            return
+        self.pending[seg] -= 1
+        fh = self.segments[seg]
+        fh.write(json.dumps({'a': event_id}) + '\n')
+        fh.flush()
+        if self.pending[seg] == 0 and seg != self.current:
+            # wake up committer to delete the segment
+            self.seq += 1
+            self.cond.notify_all()
+
+    def _delete_segment(self, seg):
+        fh = self.segments.pop(seg)
+        del self.pending[seg]
+        fh.close()
+        try:
+            os.unlink(fh.name)
+        except:
+            log_traceback()
+
+    def _committer(self):
+        while True:
+            with self.lock:
+                while self.synced >= self.seq:
+                    self.cond.wait()
+            if self.commit_delay:
+                time.sleep(self.commit_delay)
+            with self.lock:
+                seq = self.seq
+                dirty = [(seg, self.segments[seg]) for seg in self.dirty]
+                self.dirty.clear()
+                for seg, fh in dirty:
+                    fh.flush()
+            try:
+                for seg, fh in dirty:
+                    os.fsync(fh.fileno())
+                error = None
+            except Exception as e:
+                logger.error(f'CORE spool sync error: {e}')
+                log_traceback()
+                error = e
+            with self.lock:
+                self.error = error
+                self.synced = seq
+                for seg in [
+                        seg for seg, pending in self.pending.items()
+                        if not pending and seg != self.current and
+                        seg not in self.dirty
+                ]:
+                    self._delete_segment(seg)
+                self.cond.notify_all()
@@ -0,0 +1,63 @@
+__author__ = 'Altertech, http://www.altertech.com/'
+__copyright__ = 'Copyright (C) 2018-2020 Altertech Group'
+__license__ = 'Apache License 2.0'
+__version__ = '2.0.45'
+
+import threading
+import time
+import math
+
+from .core import logger, log_traceback
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel
+
+    Scheduled functions are put into wheel slots by their expiration tick and
+    are called by the wheel thread, so waiting timers occupy no other threads.
+    Functions should be fast (e.g. submit a task to a pool) to not delay other
+    timers.
+    """
+
+    def __init__(self, name, tick=0.1, slots=512):
+        self.name = name
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.lock = threading.Lock()
+        self.scheduled = 0
+        threading.Thread(target=self._run,
+                         name=f'roboger_{name}',
+                         daemon=True).start()
+
+    def schedule(self, delay, fn, *args, **kwargs):
+        """
+        Call function after delay (seconds)
+        """
+        with self.lock:
+            expires = self.current + max(math.ceil(delay / self.tick), 1)
+            self.slots[expires % len(self.slots)].append(
+                (expires, fn, args, kwargs))
+            self.scheduled += 1
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            next_tick += self.tick
+            with self.lock:
+                self.current += 1
+                slot = self.slots[self.current % len(self.slots)]
+                due = [t for t in slot if t[0] <= self.current]
+                if due:
+                    slot[:] = [t for t in slot if t[0] > self.current]
+                    self.scheduled -= len(due)
+            for _, fn, args, kwargs in due:
+                try:
+                    fn(*args, **kwargs)
+                except:
+                    logger.error(f'CORE {self.name} timer function failed')
+                    log_traceback()
@@ -22,6 +22,7 @@ setuptools.setup(name='roboger',
                      'netaddr', 'filetype', 'tebot', 'simplejson',
                      'werkzeug==0.16.1', 'python-magic'
                  ],
+                 extras_require={'async': ['aiohttp']},
                  classifiers=(
                      'Programming Language :: Python :: 3',
                      'License :: OSI Approved :: Apache Software License',
@@ -1,6 +1,7 @@
 from pathlib import Path
 import logging
 import os
+import base64
 import sys
 import signal
 import sqlalchemy
@@ -9,8 +10,10 @@ import requests
 import random
 import pytest
 import threading
+import smtplib
 from functools import partial
 from types import SimpleNamespace
+from collections import OrderedDict
 from flask import Flask, request, Response
 from textwrap import dedent
 
@@ -46,7 +49,7 @@ gunicorn = os.getenv('GUNICORN', 'gunicorn')
 dbconn = os.environ['DBCONN']
 engine = sqlalchemy.create_engine(dbconn)
 c = engine.connect()
-for tbl in ['bucket', 'subscription', 'endpoint', 'addr']:
+for tbl in ['dead_letter', 'bucket', 'subscription', 'endpoint', 'addr']:
     try:
         c.execute(f'drop table {tbl}')
     except (sqlalchemy.exc.ProgrammingError, sqlalchemy.exc.OperationalError):
@@ -63,9 +66,67 @@ if limits:
                 host: localhost:6379
                 db: 3
     """
+    if os.environ.get('LIMITS_MMAP'):
+        limits_config += f"""
+            backend: mmap
+            mmap:
+                path: /tmp/roboger-test-limits-{os.getpid()}
+    """
+    if os.environ.get('LIMITS_LEASE'):
+        limits_config += """
+            lease:
+                count: 10
+    """
 else:
     limits_config = ''
 
+if os.environ.get('ROUTING_INDEX'):
+    routing_index_config = """
+        routing-index:
+            ttl: 60
+    """
+else:
+    routing_index_config = ''
+
+if os.environ.get('ADDR_CACHE'):
+    addr_cache_config = """
+        addr-cache:
+            ttl: 60
+        cache-invalidation:
+            redis:
+                host: localhost:6379
+                db: 3
+    """
+else:
+    addr_cache_config = ''
+
+chain = os.environ.get('CHAIN')
+if chain:
+    chain_config = """
+            - name: chain
+              batch:
+                  window: 0.2
+                  max-size: 10
+    """
+else:
+    chain_config = ''
+
+if os.environ.get('HTTP_ASYNC'):
+    http_pool_config = """
+        http-pool:
+            async: true
+    """
+else:
+    http_pool_config = ''
+
+if os.environ.get('SPOOL'):
+    spool_config = f"""
+        spool:
+            dir: /tmp/roboger-test-spool-{os.getpid()}
+    """
+else:
+    spool_config = ''
+
 with open(configfile, 'w') as fh:
     fh.write(
         dedent(f"""
@@ -73,17 +134,38 @@ with open(configfile, 'w') as fh:
         db: {dbconn}
         log-tracebacks: true
         {limits_config}
+        {routing_index_config}
+        {addr_cache_config}
+        {spool_config}
+        {http_pool_config}
         secure-mode: true
         db-pool-size: 2
+        push-batch:
+            max-size: 10
+            max-bytes: 10000
         thread-pool-size: 20
         timeout: 5
+        circuit-breaker:
+            enabled: true
+            failures: 3
+            reset-timeout: 60
         plugins:
             - name: webhook
+              retry:
+                  max-attempts: 2
+                  delay: 0.1
+                  jitter: 0
             - name: email
               config:
                   smtp:
                     host: 127.0.0.1
             - name: slack
+              pool:
+                  size: 1
+                  max-size: 4
+                  reserve: 50
+                  reserved-workers: 0
+            {chain_config}
         gunicorn:
             listen: {test_server_bind}:{test_server_port}
             path: {gunicorn}
@@ -133,6 +215,41 @@ def _some_test_webhook():
     return Response(status=204)
 
 
+@_test_app.route('/webhook_test_chain', methods=['POST'])
+def _some_test_webhook_chain():
+    test_data.chain_messages.append(request.json['msg'])
+    return Response(status=204)
+
+
+@_test_app.route('/chain_test_server/push', methods=['POST'])
+def _some_test_chain_server():
+    # target server without batch API
+    test_data.chain_messages.append(request.json['msg'])
+    return Response(status=202)
+
+
+@_test_app.route('/webhook_test_slow', methods=['POST'])
+def _some_test_webhook_slow():
+    test_data.slow_release.wait(3)
+    test_data.slow_messages.append(request.json['text'])
+    return Response(status=200)
+
+
+@_test_app.route('/webhook_test_queue', methods=['POST'])
+def _some_test_webhook_queue():
+    test_data.queue_messages.append(request.json['msg'])
+    return Response(status=204)
+
+
+@_test_app.route('/webhook_test_unstable', methods=['POST'])
+def _some_test_webhook_unstable():
+    test_data.webhook_calls += 1
+    if test_data.webhook_fail:
+        return Response(status=502)
+    test_data.webhook_payload = request.json
+    return Response(status=204)
+
+
 api = ManagementAPI(f'http://{test_server_bind}:{test_server_port}', '123')
 
 
@@ -176,9 +293,9 @@ def test001_test_server():
     assert result.status_code == 204
     api.core_cleanup()
     plugins = roboger_manager.list_plugins(api=api)
-    assert len(plugins) == 3
+    assert len(plugins) == (4 if chain else 3)
     for p in plugins:
-        assert p['plugin_name'] in ['webhook', 'email', 'slack']
+        assert p['plugin_name'] in ['webhook', 'email', 'slack', 'chain']
 
 
 def test011_addr():
@@ -371,6 +488,22 @@ def test015_bucket():
             assert r.headers['x-roboger-test1'] == o['tp']
             assert r.headers['x-roboger-test2'] == '123'
             assert r.headers['roboger-file-name'] == f'test.{o["tp"]}'
+    # event media is stored once per event
+    import roboger.core
+    with open('./tests/test.jpg', 'rb') as fh:
+        content = fh.read()
+    event = roboger.core.Event('test', 'test', media=content)
+    object_id = roboger.core.event_media_put(event,
+                                             creator='test',
+                                             addr_id=addr_id)
+    assert roboger.core.event_media_put(event,
+                                        creator='test',
+                                        addr_id=addr_id) == object_id
+    r = requests.get(
+        f'http://{test_server_bind}:{test_server_port}/file/{object_id}')
+    assert r.ok
+    assert r.content == content
+    assert r.headers['Content-Type'] == 'image/jpeg'
 
 
 def test020_push():
@@ -400,7 +533,7 @@ def test020_push():
     push = partial(requests.post,
                    f'http://{test_server_bind}:{test_server_port}/push')
     payload = dict(addr=addr.a,
-                   msg='test message\ntest test',
+                   msg='test "message"\ntest\\test',
                    subject='test',
                    level=roboger.WARNING,
                    location='lab',
@@ -415,7 +548,7 @@ def test020_push():
     time.sleep(0.2)
     assert test_data.webhook_payload['event_id']
     assert test_data.webhook_payload['addr'] == addr.a
-    assert test_data.webhook_payload['msg'] == 'test message\ntest test'
+    assert test_data.webhook_payload['msg'] == 'test "message"\ntest\\test'
     for k, v in payload.items():
         if k != 'addr':
             assert v == test_data.webhook_payload[k]
@@ -447,9 +580,715 @@ def test020_push():
     assert test_data.webhook_payload['tag'] is None
     assert test_data.webhook_payload['location'] == 'home'
     assert test_data.webhook_payload['addr'] == addr.a
+    test_data.webhook_payload = None
+    push(params=dict(addr=addr.a, msg='form test', level=30,
+                     location='home'))
+    time.sleep(0.2)
+    assert test_data.webhook_payload['msg'] == 'form test'
+    assert test_data.webhook_payload['level'] == roboger.WARNING
+    ep.config = dict(
+        url=f'http://{test_app_bind}:{test_app_port}/webhook_test',
+        template='{ "msg": $msg, "media": $media }')
+    ep.save()
+    media = bytes(range(256)) * 10
+    media_encoded = base64.b64encode(media).decode()
+    test_data.webhook_payload = None
+    push(json=dict(addr=addr.a, msg='json media', level=30,
+                   location='home', media=media_encoded))
+    time.sleep(0.2)
+    assert test_data.webhook_payload['media'] == media_encoded
+    test_data.webhook_payload = None
+    assert push(data=dict(addr=addr.a, msg='multipart media', level=30,
+                          location='home'),
+                files=dict(media=('test.bin', media))).status_code == 202
+    time.sleep(0.2)
+    assert test_data.webhook_payload['msg'] == 'multipart media'
+    assert test_data.webhook_payload['media'] == media_encoded
+    test_data.webhook_payload = None
+    assert push(params=dict(addr=addr.a, msg='raw media', level=30,
+                            location='home'),
+                data=media,
+                headers={
+                    'Content-Type': 'application/octet-stream'
+                }).status_code == 202
+    time.sleep(0.2)
+    assert test_data.webhook_payload['msg'] == 'raw media'
+    assert test_data.webhook_payload['media'] == media_encoded
+    assert push(json=dict(addr=addr.a, xxx=1)).status_code == 400
+    assert push(json=dict(msg='test')).status_code == 400
+    assert push(data='{',
+                headers={
+                    'Content-Type': 'application/json'
+                }).status_code == 400
+    addr.delete()
+
+
+def test021_push_batch():
+    if limits:
+        roboger_manager.reset_addr_limits(api=api)
+    test_data.webhook_payload = None
+    addr = Addr(api=api)
+    addr.create()
+    ep = addr.create_endpoint(
+        'webhook',
+        dict(url=f'http://{test_app_bind}:{test_app_port}/webhook_test',
+             template='{ "msg": $msg, "level": $level }'))
+    ep.create_subscription(level=roboger.WARNING)
+    push_batch = partial(
+        requests.post,
+        f'http://{test_server_bind}:{test_server_port}/push/batch')
+    r = push_batch(json=[
+        dict(addr=addr.a, msg='batch test', level='warning'),
+        dict(addr=addr.a, msg='batch test', xxx=1),
+        dict(addr='x' * 64, msg='batch test'),
+        dict(msg='batch test')
+    ])
+    assert r.status_code == 200
+    result = r.json()
+    assert [x['code'] for x in result] == [202, 400, 404, 400]
+    assert result[0]['event_id']
+    time.sleep(0.2)
+    assert test_data.webhook_payload['msg'] == 'batch test'
+    assert test_data.webhook_payload['level'] == roboger.WARNING
+    test_data.webhook_payload = None
+    r = push_batch(data='\n'.join([
+        f'{{"addr": "{addr.a}", "msg": "batch test2", "level": 40}}',
+        'garbage',
+    ]),
+                   headers={'Content-Type': 'application/x-ndjson'})
+    assert r.status_code == 200
+    assert [x['code'] for x in r.json()] == [202, 400]
+    time.sleep(0.2)
+    assert test_data.webhook_payload['msg'] == 'batch test2'
+    assert push_batch(data='garbage').status_code == 400
+    # batch limits
+    assert push_batch(json=[dict(addr=addr.a, msg='batch test')] *
+                      11).status_code == 413
+    assert push_batch(json=[dict(addr=addr.a, msg='x' * 5000)] *
+                      2).status_code == 413
+    r = push_batch(json=[dict(addr=addr.a, msg='batch test')] * 10)
+    assert r.status_code == 200
+    assert [x['code'] for x in r.json()] == [202] * 10
+    addr.delete()
+
+
+def test022_retry_dead_letters():
+    if limits:
+        roboger_manager.reset_addr_limits(api=api)
+    test_data.webhook_payload = None
+    test_data.webhook_calls = 0
+    test_data.webhook_fail = True
+    addr = Addr(api=api)
+    addr.create()
+    ep = addr.create_endpoint(
+        'webhook',
+        dict(url=f'http://{test_app_bind}:{test_app_port}'
+             '/webhook_test_unstable',
+             template='{ "msg": $msg }'))
+    sub = ep.create_subscription()
+    requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                  json=dict(addr=addr.a, msg='retry test'))
+    time.sleep(1)
+    assert test_data.webhook_calls == 2
+    assert not test_data.webhook_payload
+    test_data.webhook_fail = False
+    result = api.post('/core', payload={'cmd': 'replay-dead-letters'})
+    assert result['replayed'] >= 1
+    time.sleep(0.5)
+    assert test_data.webhook_calls == 3
+    assert test_data.webhook_payload['msg'] == 'retry test'
+    api.post('/core', payload={'cmd': 'replay-dead-letters'})
+    time.sleep(0.5)
+    assert test_data.webhook_calls == 3
+
+    def dead_letters():
+        with engine.connect() as conn:
+            return conn.execute(
+                sqlalchemy.text('SELECT COUNT(*) FROM dead_letter '
+                                'WHERE endpoint_id=:id'),
+                id=ep.id).scalar()
+
+    def push_failed():
+        test_data.webhook_fail = True
+        requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                      json=dict(addr=addr.a, msg='retry test'))
+        time.sleep(1)
+        assert dead_letters() == 1
+        test_data.webhook_fail = False
+
+    # dead letters are replayed with the current endpoint config
+    push_failed()
+    ep.config = dict(ep.config, template='{ "msg": $msg, "replayed": true }')
+    ep.save()
+    api.post('/core', payload={'cmd': 'replay-dead-letters'})
+    time.sleep(0.5)
+    assert test_data.webhook_payload == {'msg': 'retry test', 'replayed': True}
+    assert not dead_letters()
+    # dead letters of inactive endpoints are dropped
+    push_failed()
+    ep.active = 0
+    ep.save()
+    calls = test_data.webhook_calls
+    api.post('/core', payload={'cmd': 'replay-dead-letters'})
+    assert not dead_letters()
+    time.sleep(0.5)
+    assert test_data.webhook_calls == calls
+    # dead letters are deleted with the endpoint
+    ep.active = 1
+    ep.save()
+    # reset host circuit failures of the previous deliveries
+    requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                  json=dict(addr=addr.a, msg='retry test'))
+    time.sleep(0.5)
+    push_failed()
+    sub.delete()
+    ep.delete()
+    assert not dead_letters()
+    addr.delete()
+
+
+def test023_circuit_breaker():
+    if limits:
+        roboger_manager.reset_addr_limits(api=api)
+    addr = Addr(api=api)
+    addr.create()
+    ep = addr.create_endpoint('webhook', dict(url='http://127.0.0.1:1/'))
+    ep.create_subscription()
+    state = api.get(f'/addr/{addr.a}/endpoint/{ep.id}')['circuit_breaker']
+    assert state['endpoint']['state'] == 'closed'
+    assert state['host']['state'] == 'closed'
+    for _ in range(2):
+        requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                      json=dict(addr=addr.a, msg='circuit test'))
+    time.sleep(1)
+    state = api.get(f'/addr/{addr.a}/endpoint/{ep.id}')['circuit_breaker']
+    assert state['endpoint']['state'] == 'open'
+    assert state['endpoint']['failures'] >= 3
+    assert state['host']['state'] == 'open'
+    # deliveries to open circuits are moved to dead letters after retries
+    requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                  json=dict(addr=addr.a, msg='circuit open test'))
+    for _ in range(30):
+        time.sleep(0.1)
+        with engine.connect() as conn:
+            errors = [
+                error for event, error in conn.execute(
+                    sqlalchemy.text('SELECT event, error FROM dead_letter '
+                                    'WHERE addr_id=:id'),
+                    id=addr.id).fetchall()
+                if 'circuit open test' in str(event)
+            ]
+        if errors:
+            break
+    assert errors == ['circuit is open']
+    # endpoint errors do not open the host circuit
+    ep = addr.create_endpoint(
+        'webhook',
+        dict(url=f'http://{test_app_bind}:{test_app_port}/webhook_test_404'))
+    ep.create_subscription()
+    for _ in range(2):
+        requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                      json=dict(addr=addr.a, msg='circuit test'))
+    time.sleep(1)
+    state = api.get(f'/addr/{addr.a}/endpoint/{ep.id}')['circuit_breaker']
+    assert state['endpoint']['state'] == 'open'
+    assert state['host']['state'] == 'closed'
+    addr.delete()
+    with engine.connect() as conn:
+        assert not conn.execute(
+            sqlalchemy.text('SELECT COUNT(*) FROM dead_letter '
+                            'WHERE addr_id=:id'),
+            id=addr.id).scalar()
+    if os.environ.get('SKIP_BUCKET_TEST'): return
+    # batch-level error is counted once per circuit
+    from roboger.breaker import CircuitBreaker
+    breaker, r._d.breaker = r._d.breaker, CircuitBreaker(100, 30)
+    send_failed, r._send_failed = r._send_failed, lambda *a, **kw: False
+    try:
+        error = ConnectionError('batch failed')
+        r._send_batch_done('webhook', None, [
+            (None, dict(event_id=i, endpoint_id=i % 2,
+                        config=dict(url='http://batch.test/')))
+            for i in range(4)
+        ], [error] * 4)
+        assert r._d.breaker.state('host:batch.test')['failures'] == 1
+        assert r._d.breaker.state('endpoint:0')['failures'] == 1
+        assert r._d.breaker.state('endpoint:1')['failures'] == 1
+    finally:
+        r._d.breaker = breaker
+        r._send_failed = send_failed
+
+
+def test024_limits():
+    if not limits:
+        return
+    roboger_manager.reset_addr_limits(api=api)
+    addr = Addr(api=api)
+    addr.create()
+    api.patch(f'/addr/{addr.a}', payload={'lim_c': 10, 'lim_s': 1000})
+    push = partial(requests.post,
+                   f'http://{test_server_bind}:{test_server_port}/push')
+    for _ in range(9):
+        assert push(json=dict(addr=addr.a, msg='test')).status_code == 202
+    # 10% are reserved for WARNING and higher levels
+    assert push(json=dict(addr=addr.a, msg='test')).status_code == 429
+    assert push(json=dict(addr=addr.a, msg='test',
+                          level='warning')).status_code == 202
+    assert push(json=dict(addr=addr.a, msg='test',
+                          level='warning')).status_code == 429
+    roboger_manager.reset_addr_limits(api=api)
+    assert push(json=dict(addr=addr.a, msg='x' * 1001)).status_code == 429
+    assert push(json=dict(addr=addr.a, msg='test')).status_code == 202
+    addr.delete()
+
+
+def test025_chain_batch():
+    if not chain:
+        return
+    if limits:
+        roboger_manager.reset_addr_limits(api=api)
+    test_data.chain_messages = []
+    target = Addr(api=api)
+    target.create()
+    target.create_endpoint(
+        'webhook',
+        dict(url=f'http://{test_app_bind}:{test_app_port}/webhook_test_chain',
+             template='{ "msg": $msg }')).create_subscription()
+    addr = Addr(api=api)
+    addr.create()
+    addr.create_endpoint(
+        'chain',
+        dict(url=f'http://{test_server_bind}:{test_server_port}/',
+             addr=target.a)).create_subscription()
+    for i in range(5):
+        requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                      json=dict(addr=addr.a, msg=f'chain test {i}'))
+    time.sleep(1)
+    assert sorted(test_data.chain_messages) == [
+        f'chain test {i}' for i in range(5)
+    ]
+    # target server without batch API
+    test_data.chain_messages = []
+    addr2 = Addr(api=api)
+    addr2.create()
+    addr2.create_endpoint(
+        'chain',
+        dict(url=f'http://{test_app_bind}:{test_app_port}/chain_test_server',
+             addr=target.a)).create_subscription()
+    for i in range(3):
+        requests.post(f'http://{test_server_bind}:{test_server_port}/push',
+                      json=dict(addr=addr2.a, msg=f'chain test {i}'))
+    time.sleep(0.5)
+    assert sorted(test_data.chain_messages) == [
+        f'chain test {i}' for i in range(3)
+    ]
+    addr2.delete()
+    addr.delete()
+    target.delete()
+
+
+def test026_batcher_urgent():
+    from roboger.dispatcher import Batcher
+    flushed = []
+    scheduled = []
+    batcher = Batcher('test',
+                      lambda key, batch: flushed.append((key, batch)),
+                      window=10,
+                      max_size=100,
+                      timer=SimpleNamespace(
+                          schedule=lambda *args: scheduled.append(args)))
+    batcher.put('host1', 1)
+    batcher.put('host1', 2)
+    assert not flushed
+    assert batcher.pending() == 2
+    # urgent item flushes the batch with the items collected before
+    batcher.put('host1', 3, urgent=True)
+    assert flushed == [('host1', [1, 2, 3])]
+    batcher.put('host2', 4, urgent=True)
+    assert flushed[1] == ('host2', [4])
+    assert batcher.pending() == 0
+    # window expiration of the already flushed batch is ignored
+    assert len(scheduled) == 1
+    _, expire, *args = scheduled[0]
+    expire(*args)
+    assert len(flushed) == 2
+
+
+class _FakeSMTP:
+    """
+    Fake SMTP session for the email plugin session pool tests
+    """
+    sessions = []
+    # called with the session on each sendmail
+    on_send = None
+
+    def __init__(self, host, port, timeout=None):
+        self.timeout = timeout
+        self.sent = []
+        self.closed = False
+        _FakeSMTP.sessions.append(self)
+
+    def ehlo(self):
+        pass
+
+    def noop(self):
+        return (250, b'OK')
+
+    def sendmail(self, sender, rcpt, body):
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected
+        if _FakeSMTP.on_send:
+            _FakeSMTP.on_send(self)
+        self.sent.append((sender, rcpt, body))
+        return {}
+
+    def quit(self):
+        self.closed = True
+
+    close = quit
+
+
+def _fake_smtp_pool(size=2):
+    from roboger.plugins.email import _SessionPool
+    _FakeSMTP.sessions = []
+    _FakeSMTP.on_send = None
+    return _SessionPool(SimpleNamespace(sendfunc=_FakeSMTP,
+                                        host='localhost',
+                                        port=25,
+                                        debug=False,
+                                        tls=False,
+                                        login=None),
+                        size=size,
+                        idle_timeout=60)
+
+
+def test027_email_session_pool():
+    pool = _fake_smtp_pool()
+    message = ('test@localhost', ['x@x'], 'test')
+    # sessions are reused
+    assert pool.sendmail([message]) == [None]
+    assert pool.sendmail([message, message]) == [None, None]
+    assert len(_FakeSMTP.sessions) == 1
+    assert len(_FakeSMTP.sessions[0].sent) == 3
+    assert _FakeSMTP.sessions[0].timeout
+    # dropped session is closed and the message is sent with a new one
+    _FakeSMTP.sessions[0].closed = True
+    assert pool.sendmail([message]) == [None]
+    assert len(_FakeSMTP.sessions) == 2
+    assert len(_FakeSMTP.sessions[1].sent) == 1
+    # session with a socket error is closed and discarded
+
+    def socket_error(sm):
+        _FakeSMTP.on_send = None
+        raise ConnectionResetError
+
+    _FakeSMTP.on_send = socket_error
+    result = pool.sendmail([message])
+    assert isinstance(result[0], ConnectionResetError)
+    assert _FakeSMTP.sessions[1].closed
+    assert pool.sendmail([message]) == [None]
+    assert len(_FakeSMTP.sessions) == 3
+    # pool is exhausted, sendmail waits for a free session
+    pool = _fake_smtp_pool(size=1)
+    release = threading.Event()
+    _FakeSMTP.on_send = lambda sm: release.wait()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(
+            pool.sendmail([message]))) for _ in range(2)
+    ]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)
+    assert not results
+    assert len(_FakeSMTP.sessions) == 1
+    release.set()
+    for t in threads:
+        t.join()
+    assert results == [[None], [None]]
+    assert len(_FakeSMTP.sessions) == 1
+    assert len(_FakeSMTP.sessions[0].sent) == 2
+
+
+def test028_telegram_file_id_cache(monkeypatch):
+    if os.environ.get('SKIP_BUCKET_TEST'): return
+    from roboger.plugins import telegram
+    from roboger.event import Event
+    calls = []
+    uploading = threading.Event()
+    release = threading.Event()
+
+    def call(method, payload=None, files=None, retry=None):
+        calls.append((method, payload, files))
+        if files:
+            uploading.set()
+            release.wait()
+        return {'ok': True, 'result': {'photo': [{'file_id': 'FILE_ID'}]}}
+
+    monkeypatch.setattr(telegram.bot, 'call', call)
+    monkeypatch.setattr(telegram.bot, 'default_reply_markup', {'test': 1})
+    monkeypatch.setattr(telegram._d, 'file_ids', OrderedDict())
+    with open('./tests/test.png', 'rb') as fh:
+        event = Event('test', 'test', media=fh.read())
+    # concurrent sends of the same media upload it once
+    threads = [
+        threading.Thread(target=telegram._send_media,
+                         args=(chat_id, event.media, 'test'),
+                         kwargs={'event': event}) for chat_id in (1, 2)
+    ]
+    threads[0].start()
+    uploading.wait()
+    threads[1].start()
+    time.sleep(0.2)
+    assert len(calls) == 1
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(calls) == 2
+    method, payload, files = calls[0]
+    assert method == 'sendPhoto'
+    assert files['photo'] == event.media
+    assert payload['reply_markup'] == {'test': 1}
+    # the next send reuses the cached file_id
+    method, payload, files = calls[1]
+    assert payload['photo'] == 'FILE_ID'
+    assert payload['chat_id'] == 2
+    assert payload['reply_markup'] == {'test': 1}
+    assert not files
+
+
+def test029_dispatch_queue():
+    if limits:
+        roboger_manager.reset_addr_limits(api=api)
+    test_data.queue_messages = []
+    test_data.slow_messages = []
+    test_data.slow_release = threading.Event()
+    addr = Addr(api=api)
+    addr.create()
+    slow_url = f'http://{test_app_bind}:{test_app_port}/webhook_test_slow'
+    addr.create_endpoint('slack', dict(url=slow_url)).create_subscription()
+    push = partial(requests.post,
+                   f'http://{test_server_bind}:{test_server_port}/push')
+    # the only pool worker is busy
+    assert push(json=dict(addr=addr.a, msg='test')).status_code == 202
+    time.sleep(0.2)
+    # 50% of the queue is reserved for WARNING and higher levels
+    for _ in range(2):
+        assert push(json=dict(addr=addr.a, msg='test')).status_code == 202
+    r = push(json=dict(addr=addr.a, msg='test'))
+    assert r.status_code == 429
+    assert int(r.headers['Retry-After']) >= 1
+    for _ in range(2):
+        assert push(json=dict(addr=addr.a, msg='test',
+                              level='warning')).status_code == 202
+    r = push(json=dict(addr=addr.a, msg='test', level='warning'))
+    assert r.status_code == 503
+    assert int(r.headers['Retry-After']) >= 1
+    # event is rejected for all targets, if any pool is full
+    addr2 = Addr(api=api)
+    addr2.create()
+    addr2.create_endpoint('slack', dict(url=slow_url)).create_subscription()
+    addr2.create_endpoint(
+        'webhook',
+        dict(url=f'http://{test_app_bind}:{test_app_port}/webhook_test_queue',
+             template='{ "msg": $msg }')).create_subscription()
+    assert push(json=dict(addr=addr2.a, msg='test',
+                          level='error')).status_code == 503
+    dispatcher = api.test()['dispatcher']['plugins']
+    assert dispatcher['webhook']['reserved'] == 0
+    assert dispatcher['slack']['reserved'] == 0
+    assert dispatcher['slack']['queued'] == 4
+    test_data.slow_release.set()
+    time.sleep(1)
+    assert len(test_data.slow_messages) == 5
+    assert not test_data.queue_messages
+    addr2.delete()
     addr.delete()
 
 
+def test030_spool_replay(tmp_path):
+    from roboger.spool import Spool
+
+    def spool_open():
+        spool = Spool(tmp_path, segment_size=1 << 20, commit_delay=0)
+        replay = spool.open()
+        return spool, sorted(event['msg'] for event, _ in replay)
+
+    def spool_drop(spool):
+        # the worker is stopped, its slot lock is released
+        spool._lock_fh.close()
+
+    # unacknowledged events are replayed after restart
+    spool, replay = spool_open()
+    assert not replay
+    spool.put('e1', {'msg': 'e1'}, [['webhook', 1, 1, {}]])
+    spool.put('e2', {'msg': 'e2'}, [['webhook', 1, 1, {}]])
+    spool.ack('e1')
+    spool_drop(spool)
+    spool, replay = spool_open()
+    assert replay == ['e2']
+    assert spool.slot.name == '0'
+    spool.ack('e2')
+    # events of other free slots are adopted, locked slots are skipped
+    spools = [spool] + [spool_open()[0] for _ in range(2)]
+    for i, spool in enumerate(spools):
+        spool.put(f'e{i}', {'msg': f'e{i}'}, [])
+    spool_drop(spools[0])
+    spool_drop(spools[2])
+    spool, replay = spool_open()
+    assert spool.slot.name == '0'
+    assert replay == ['e0', 'e2']
+    assert not list((tmp_path / '2').glob('*.spool'))
+    assert list((tmp_path / '1').glob('*.spool'))
+    spool.ack('e0')
+    spool.ack('e2')
+    spool_drop(spool)
+    spool, replay = spool_open()
+    assert not replay
+
+
+def test031_dispatcher_priority(monkeypatch):
+    import roboger.dispatcher
+    from roboger.dispatcher import Dispatcher
+    clock = SimpleNamespace(now=1000)
+    monkeypatch.setattr(roboger.dispatcher, 'time',
+                        SimpleNamespace(monotonic=lambda: clock.now))
+    d = Dispatcher('test', workers=0, reserved_workers=0, max_wait=10)
+
+    def get(reserved=False):
+        with d.lock:
+            return d._get(reserved)[2][0]
+
+    # ERROR and higher levels go first
+    d.submit(None, 'info', _level=20)
+    d.submit(None, 'debug', _level=10)
+    d.submit(None, 'error', _level=40)
+    d.submit(None, 'warning', _level=30)
+    assert [get() for _ in range(4)] == ['error', 'warning', 'info', 'debug']
+    # priority grows with waiting time
+    d.submit(None, 'info', _level=20)
+    clock.now += 2
+    d.submit(None, 'warning', _level=30)
+    assert [get() for _ in range(2)] == ['info', 'warning']
+    # INFO, waiting for more than max_wait, overtakes ERROR
+    d.submit(None, 'info', _level=20)
+    d.submit(None, 'error', _level=40)
+    d.submit(None, 'error', _level=40)
+    clock.now += 7
+    assert get() == 'error'
+    clock.now += 1
+    assert [get() for _ in range(2)] == ['info', 'error']
+    # reserved workers take ERROR and higher levels only
+    d.submit(None, 'info', _level=20)
+    d.submit(None, 'error', _level=40)
+    assert get(reserved=True) == 'error'
+    result = []
+    t = threading.Thread(target=lambda: result.append(get(reserved=True)))
+    t.start()
+    t.join(0.2)
+    assert t.is_alive()
+    d.submit(None, 'critical', _level=50)
+    t.join()
+    assert result == ['critical']
+    assert get() == 'info'
+
+
+def test032_media_encoded():
+    if os.environ.get('SKIP_BUCKET_TEST'): return
+    from roboger.event import Event
+    import roboger.plugins.email
+    event = Event('test', 'test', media=b'test')
+    # media is encoded for plugins, which don't declare they don't need it
+    kwargs = r._delivery_kwargs(SimpleNamespace(), event)
+    assert kwargs['media_encoded'] == base64.b64encode(b'test').decode()
+    kwargs = r._delivery_kwargs(roboger.plugins.email, event)
+    assert kwargs['media_encoded'] is None
+    assert kwargs['media'] == b'test'
+
+
+def test033_android_invalid_token(monkeypatch):
+    pytest.importorskip('pyfcm')
+    from roboger.plugins import android
+    from roboger.event import Event
+    deactivated = []
+    sent = []
+
+    def multiple_devices_data_message(registration_ids, data_message):
+        sent.append(registration_ids)
+        return {
+            'results': [{
+                'message_id': '1'
+            }, {
+                'error': 'NotRegistered'
+            }, {
+                'message_id': '3'
+            }]
+        }
+
+    monkeypatch.setattr(android._cfg,
+                        'push_service',
+                        SimpleNamespace(multiple_devices_data_message=
+                                        multiple_devices_data_message),
+                        raising=False)
+    monkeypatch.setattr(android, 'endpoint_update',
+                        lambda i, data: deactivated.append((i, data)))
+    event = Event('test', 'test', msg='test')
+    results = android.send_batch([
+        dict(config={'registration_id': f'token{i}'},
+             endpoint_id=i,
+             addr_id=1,
+             event=event,
+             **event.kwargs()) for i in range(1, 4)
+    ])
+    assert sent == [['token1', 'token2', 'token3']]
+    assert results == [None, None, None]
+    assert deactivated == [(2, {'active': 0})]
+
+
+def test034_email_multi_rcpt(monkeypatch):
+    from roboger.plugins import email
+    from roboger.event import Event
+    event = Event('test', 'test', msg='test', subject='test')
+    deliveries = [
+        dict(config={'rcpt': f'x{i}@x'}, event=event, **event.kwargs())
+        for i in range(3)
+    ]
+    # one message for all recipients of the event
+    monkeypatch.setattr(email._d, 'pool', _fake_smtp_pool())
+    monkeypatch.setattr(email._d, 'multi_rcpt', True)
+    assert email.send_batch(deliveries) == [None, None, None]
+    sent = _FakeSMTP.sessions[0].sent
+    assert len(sent) == 1
+    assert sent[0][1] == ['x0@x', 'x1@x', 'x2@x']
+    # separate messages, if disabled
+    monkeypatch.setattr(email._d, 'pool', _fake_smtp_pool())
+    monkeypatch.setattr(email._d, 'multi_rcpt', False)
+    assert email.send_batch(deliveries) == [None, None, None]
+    sent = _FakeSMTP.sessions[0].sent
+    assert [rcpt for _, rcpt, _ in sent] == [['x0@x'], ['x1@x'], ['x2@x']]
+    assert 'To: x1@x' in sent[1][2]
+
+
+def test035_endpoint_cache(monkeypatch):
+    monkeypatch.setattr(r._d, 'endpoints', OrderedDict())
+    monkeypatch.setattr(r._d, 'endpoint_cache_size', 2)
+    monkeypatch.setattr(r, '_notify_invalidation', lambda **kwargs: None)
+    get = partial(r._endpoint_get_cached, plugin_name='x')
+    get(1, config={'a': 1}, addr_id=10)
+    get(2, config={'a': 2}, addr_id=10)
+    # hit moves the entry to the end, so the least recently used is evicted
+    assert get(1, config={'a': 1}).addr_id == 10
+    get(3, config={'a': 3}, addr_id=20)
+    assert list(r._d.endpoints) == [1, 3]
+    # changed config replaces the entry
+    assert get(3, config={'a': 4}, addr_id=20).config == {'a': 4}
+    assert len(r._d.endpoints) == 2
+    r._endpoint_cache_drop(addr_id=10)
+    assert list(r._d.endpoints) == [3]
+    r._endpoint_cache_drop(endpoint_id=3)
+    assert not r._d.endpoints
+
+
 def test999_cleanup():
     addr = roboger_manager.create_addr(api=api)
     addr2 = roboger_manager.create_addr(api=api)